@@ -0,0 +1,831 @@
+"""
+Copyright 2014, Michael Solberg <msolberg@redhat.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+02110-1301  USA
+"""
+
+#### Imports
+
+import BaseHTTPServer, SocketServer
+import os, uuid, time, json, random, re, threading, getopt, sys, tempfile, hashlib, urlparse, urllib, socket, ast
+
+#### Defs
+
+# Default behaviour of the fake cloud.  Latencies are in seconds and are
+# keyed by operation, e.g. 'cinder.POST.volumes', with '*' for everything
+# else.  Failures are the probability that an operation returns a 500.
+default_config = {
+    'latency': {'*': 0.0},
+    'failures': {},
+    # How long asynchronous resources take to change state
+    'volume_create_time': 1.0,
+    'volume_delete_time': 0.5,
+    'server_schedule_time': 0.5,
+    'server_build_time': 2.0,
+    'server_delete_time': 0.5,
+    # Probability that a volume or server ends up in error
+    'volume_error_rate': 0.0,
+    'server_error_rate': 0.0,
+    'admin_user': 'admin',
+    'admin_pass': 'password',
+    'admin_tenant': 'admin',
+    'images': ['cirros'],
+    'flavors': ['m1.tiny', 'm1.small', 'm1.medium'],
+}
+
+class FakeError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+def _now():
+    return time.time()
+
+def _isotime(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+class FakeStack(object):
+    """In-process stand-in for the Keystone, Glance, Neutron, Cinder and Nova APIs teapot uses
+
+    Every service is served from one port under its own prefix, and the
+    Keystone service catalog points the clients at them.  State is only
+    kept in memory, and volumes and servers change status based on how
+    long ago they were created or deleted.
+    """
+    def __init__(self, host='127.0.0.1', port=0, config=None):
+        self.config = dict(default_config)
+        self.config.update(config or {})
+        self.host = host
+        self.port = port
+        self.lock = threading.RLock()
+        self.counts = {}
+        self.server = None
+        self.tenants = {}
+        self.users = {}
+        self.tokens = {}
+        self.images = {}
+        self.flavors = {}
+        self.keypairs = {}
+        self.networks = {}
+        self.subnets = {}
+        self.routers = {}
+        self.ports = {}
+        self.volumes = {}
+        self.servers = {}
+        admin_tenant = self._add_tenant(self.config['admin_tenant'])
+        self._add_user(self.config['admin_user'], self.config['admin_pass'], admin_tenant['id'])
+        for name in self.config['images']:
+            self._add_image({'name': name, 'status': 'active', 'is_public': True, 'size': 0})
+        for n, name in enumerate(self.config['flavors']):
+            self.flavors[str(n + 1)] = {'id': str(n + 1), 'name': name, 'ram': 512 * 2 ** n,
+                                        'vcpus': n + 1, 'disk': 1 + 10 * n}
+
+    #### Server lifecycle
+
+    def start(self):
+        """Start serving in a background thread and return self"""
+        stack = self
+        class Handler(FakeHandler):
+            fake = stack
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.close_connections()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d'% (self.host, self.port)
+
+    @property
+    def keystone_url(self):
+        return '%s/identity/v2.0'% self.url
+
+    def calls(self):
+        """Return the total number of API calls served so far"""
+        with self.lock:
+            return sum(self.counts.values())
+
+    #### Helpers
+
+    def _count(self, operation):
+        with self.lock:
+            self.counts[operation] = self.counts.get(operation, 0) + 1
+
+    def _delay(self, operation):
+        latency = self.config['latency']
+        delay = latency.get(operation, latency.get('*', 0.0))
+        if delay:
+            time.sleep(delay)
+
+    def _maybe_fail(self, operation):
+        if random.random() < self.config['failures'].get(operation, self.config['failures'].get('*', 0.0)):
+            raise FakeError(500, "Injected failure in %s"% operation)
+
+    def _add_tenant(self, name, description='', enabled=True):
+        for t in self.tenants.values():
+            if t['name'] == name:
+                raise FakeError(409, "Tenant %s already exists"% name)
+        t = {'id': uuid.uuid4().hex, 'name': name, 'description': description, 'enabled': enabled}
+        self.tenants[t['id']] = t
+        return t
+
+    def _add_user(self, name, password, tenant_id=None, email=None, enabled=True):
+        for u in self.users.values():
+            if u['name'] == name:
+                raise FakeError(409, "User %s already exists"% name)
+        u = {'id': uuid.uuid4().hex, 'name': name, 'password': password, 'tenantId': tenant_id,
+             'email': email, 'enabled': enabled}
+        self.users[u['id']] = u
+        return u
+
+    def _add_image(self, meta):
+        image = {'id': str(uuid.uuid4()), 'name': None, 'status': 'queued', 'is_public': False,
+                 'size': 0, 'checksum': None, 'disk_format': None, 'container_format': None,
+                 'created_at': _isotime(_now()), 'deleted': False, 'properties': {}, 'file': None}
+        image.update(meta)
+        self.images[image['id']] = image
+        return image
+
+    def _public_user(self, u):
+        return dict((k, v) for k, v in u.items() if k != 'password')
+
+    def _catalog(self, tenant_id):
+        def entry(service_type, name, url):
+            return {'type': service_type, 'name': name,
+                    'endpoints': [{'region': 'RegionOne', 'publicURL': url, 'adminURL': url,
+                                   'internalURL': url, 'id': uuid.uuid4().hex}],
+                    'endpoints_links': []}
+        return [entry('identity', 'keystone', self.keystone_url),
+                entry('image', 'glance', '%s/image'% self.url),
+                entry('network', 'neutron', '%s/network'% self.url),
+                entry('volume', 'cinder', '%s/volume/v1/%s'% (self.url, tenant_id)),
+                entry('compute', 'nova', '%s/compute/v2/%s'% (self.url, tenant_id))]
+
+    def _authorize(self, headers):
+        token = self.tokens.get(headers.get('x-auth-token'))
+        if token is None or token['expires'] < _now():
+            raise FakeError(401, "Authentication required")
+        return token
+
+    def _visible(self, item, token, query=None, tenant_filter='tenant_id'):
+        """Whether item is the token's tenant's, or is listed across tenants by the admin"""
+        if token['user']['name'] == self.config['admin_user']:
+            if query is None:
+                return True
+            if 'all_tenants' in query:
+                return tenant_filter not in query or item['tenant_id'] == query[tenant_filter][0]
+        return item['tenant_id'] == token['tenant']['id']
+
+    #### Asynchronous status
+
+    def _volume_status(self, v):
+        now = _now()
+        if v['deleted_at'] is not None:
+            if now - v['deleted_at'] >= self.config['volume_delete_time']:
+                del self.volumes[v['id']]
+                return None
+            return 'deleting'
+        if now - v['created_at'] < self.config['volume_create_time']:
+            return 'creating'
+        if v['error']:
+            return 'error'
+        attached = v['attached_to']
+        if attached and self._server_status(self.servers.get(attached)) is not None:
+            return 'in-use'
+        return 'available'
+
+    def _server_status(self, s):
+        """Return (status, task_state) or None once the server is gone"""
+        if s is None:
+            return None
+        now = _now()
+        if s['deleted_at'] is not None:
+            if now - s['deleted_at'] >= self.config['server_delete_time']:
+                del self.servers[s['id']]
+                return None
+            return 'ACTIVE', 'deleting'
+        age = now - s['created_at']
+        if age < self.config['server_schedule_time']:
+            return 'BUILD', 'scheduling'
+        if age < self.config['server_schedule_time'] + self.config['server_build_time']:
+            return 'BUILD', 'spawning'
+        if s['error']:
+            return 'ERROR', None
+        return 'ACTIVE', None
+
+    def _volume_view(self, v):
+        status = self._volume_status(v)
+        if status is None:
+            return None
+        view = dict((k, v[k]) for k in ('id', 'display_name', 'display_description', 'size',
+                                          'volume_type', 'snapshot_id', 'metadata', 'availability_zone'))
+        view['os-vol-tenant-attr:tenant_id'] = v['tenant_id']
+        view['status'] = status
+        view['created_at'] = _isotime(v['created_at'])
+        view['attachments'] = []
+        if status == 'in-use':
+            view['attachments'] = [{'server_id': v['attached_to'], 'volume_id': v['id'], 'device': '/dev/vda'}]
+        if v['image_id']:
+            view['volume_image_metadata'] = {'image_id': v['image_id']}
+        return view
+
+    def _server_view(self, s):
+        state = self._server_status(s)
+        if state is None:
+            return None
+        view = dict((k, s[k]) for k in ('id', 'name', 'tenant_id', 'user_id', 'key_name', 'metadata'))
+        view['status'], view['OS-EXT-STS:task_state'] = state
+        view['image'] = {'id': s['image_id'], 'links': []}
+        view['flavor'] = {'id': s['flavor_id'], 'links': []}
+        view['addresses'] = {}
+        view['links'] = []
+        view['created'] = _isotime(s['created_at'])
+        return view
+
+    #### Dispatch
+
+    def handle(self, method, path, query, headers, body):
+        """Serve one request and return (status, headers, body)"""
+        parts = [urllib.unquote(p) for p in path.strip('/').split('/') if p]
+        if not parts:
+            raise FakeError(404, "Not found")
+        service = parts.pop(0)
+        if service == 'identity':
+            parts = parts[1:]
+        elif service in ('volume', 'compute'):
+            parts = parts[2:]
+        elif service == 'network':
+            parts = parts[1:]
+            if parts:
+                parts[-1] = parts[-1].rsplit('.json', 1)[0]
+        elif service == 'image':
+            parts = parts[1:]
+        else:
+            raise FakeError(404, "No service %s"% service)
+        collection = parts[0] if parts else ''
+        operation = '%s.%s.%s'% ({'identity': 'keystone', 'image': 'glance', 'network': 'neutron',
+                                   'volume': 'cinder', 'compute': 'nova'}[service], method, collection)
+        self._count(operation)
+        self._delay(operation)
+        self._maybe_fail(operation)
+        handler = getattr(self, '_%s'% service)
+        with self.lock:
+            if not (service == 'identity' and parts == ['tokens']):
+                token = self._authorize(headers)
+            else:
+                token = None
+            return handler(method, parts, query, headers, body, token)
+
+    #### Keystone v2.0
+
+    def _identity(self, method, parts, query, headers, body, token):
+        if parts == ['tokens'] and method == 'POST':
+            auth = json.loads(body).get('auth', {})
+            creds = auth.get('passwordCredentials', {})
+            user = None
+            for u in self.users.values():
+                if u['name'] == creds.get('username') and u['password'] == creds.get('password'):
+                    user = u
+            if user is None:
+                raise FakeError(401, "Invalid user / password")
+            tenant = None
+            for t in self.tenants.values():
+                if t['name'] == auth.get('tenantName') or t['id'] == auth.get('tenantId'):
+                    tenant = t
+            if tenant is None:
+                raise FakeError(401, "Invalid tenant")
+            expires = _now() + 3600
+            token_id = uuid.uuid4().hex
+            self.tokens[token_id] = {'user': user, 'tenant': tenant, 'expires': expires}
+            return 200, {}, {'access': {'token': {'id': token_id, 'expires': _isotime(expires),
+                                                  'issued_at': _isotime(_now()), 'tenant': tenant},
+                                        'serviceCatalog': self._catalog(tenant['id']),
+                                        'user': {'id': user['id'], 'name': user['name'], 'username': user['name'],
+                                                 'roles': [{'name': 'admin'}], 'roles_links': []},
+                                        'metadata': {'is_admin': 0, 'roles': []}}}
+        kind = parts[0][:-1]
+        store = {'tenant': self.tenants, 'user': self.users}.get(kind)
+        if store is None:
+            raise FakeError(404, "Not found")
+        if len(parts) == 1 and method == 'GET':
+            if 'name' in query:
+                for item in store.values():
+                    if item['name'] == query['name'][0]:
+                        return 200, {}, {kind: self._public_user(item)}
+                raise FakeError(404, "Could not find %s %s"% (kind, query['name'][0]))
+            return 200, {}, {parts[0]: [self._public_user(i) for i in store.values()]}
+        if len(parts) == 1 and method == 'POST':
+            data = json.loads(body)[kind]
+            if kind == 'tenant':
+                item = self._add_tenant(data['name'], data.get('description', ''), data.get('enabled', True))
+            else:
+                item = self._add_user(data['name'], data.get('password'), data.get('tenantId'),
+                                      data.get('email'), data.get('enabled', True))
+            return 200, {}, {kind: self._public_user(item)}
+        item = store.get(parts[1])
+        if item is None:
+            raise FakeError(404, "Could not find %s %s"% (kind, parts[1]))
+        if method == 'GET':
+            return 200, {}, {kind: self._public_user(item)}
+        if method == 'DELETE':
+            del store[parts[1]]
+            return 204, {}, None
+        raise FakeError(405, "Method not allowed")
+
+    #### Glance v1
+
+    def _image_headers(self, image):
+        h = {}
+        for k in ('id', 'name', 'status', 'size', 'checksum', 'disk_format', 'container_format',
+                  'created_at', 'deleted'):
+            if image[k] is not None:
+                h['x-image-meta-%s'% k.replace('_', '-')] = str(image[k])
+        h['x-image-meta-is_public'] = str(image['is_public'])
+        for k, v in image['properties'].items():
+            h['x-image-meta-property-%s'% k] = str(v)
+        return h
+
+    def _image_view(self, image):
+        return dict((k, v) for k, v in image.items() if k != 'file')
+
+    def _image(self, method, parts, query, headers, body, token):
+        if parts[:1] != ['images']:
+            raise FakeError(404, "Not found")
+        if method == 'GET' and (len(parts) == 1 or parts[1] == 'detail'):
+            images = sorted(self.images.values(), key=lambda i: i['created_at'])
+            for key in ('name', 'status', 'disk_format', 'container_format'):
+                if key in query:
+                    images = [i for i in images if str(i[key]) == query[key][0]]
+            for key in query:
+                if key.startswith('property-'):
+                    prop = key[len('property-'):]
+                    images = [i for i in images if str(i['properties'].get(prop)) == query[key][0]]
+            if 'marker' in query:
+                ids = [i['id'] for i in images]
+                if query['marker'][0] in ids:
+                    images = images[ids.index(query['marker'][0]) + 1:]
+            if 'limit' in query:
+                images = images[:int(query['limit'][0])]
+            return 200, {}, {'images': [self._image_view(i) for i in images]}
+        if method == 'POST' and len(parts) == 1:
+            meta = {'status': 'active', 'properties': {}}
+            for k, v in headers.items():
+                if k.startswith('x-image-meta-property-'):
+                    meta['properties'][k[len('x-image-meta-property-'):]] = v
+                elif k.startswith('x-image-meta-'):
+                    key = k[len('x-image-meta-'):].replace('-', '_')
+                    meta[key] = v.lower() == 'true' if key == 'is_public' else v
+            image = self._add_image(meta)
+            if body is not None:
+                image['file'], image['size'], image['checksum'] = body
+            elif 'location' not in meta:
+                image['status'] = 'queued'
+            image['size'] = int(image['size'] or 0)
+            return 201, {}, {'image': self._image_view(image)}
+        image = self.images.get(parts[1]) if len(parts) > 1 else None
+        if image is None:
+            raise FakeError(404, "Image not found")
+        if method == 'HEAD':
+            return 200, self._image_headers(image), None
+        if method == 'GET':
+            return 200, self._image_headers(image), image['file']
+        if method == 'PUT':
+            if body is not None:
+                image['file'], image['size'], image['checksum'] = body
+                image['status'] = 'active'
+            return 200, {}, {'image': self._image_view(image)}
+        if method == 'DELETE':
+            del self.images[image['id']]
+            if image['file'] is not None:
+                image['file'].close()
+            return 200, {}, None
+        raise FakeError(405, "Method not allowed")
+
+    #### Neutron v2.0
+
+    def _network(self, method, parts, query, headers, body, token):
+        if not parts:
+            raise FakeError(404, "Not found")
+        plural = parts[0]
+        store = {'networks': self.networks, 'subnets': self.subnets,
+                 'routers': self.routers, 'ports': self.ports}.get(plural)
+        if store is None:
+            raise FakeError(404, "Not found")
+        single = plural[:-1]
+        tenant_id = token['tenant']['id']
+        if method == 'GET' and len(parts) == 1:
+            items = [i for i in store.values() if i['tenant_id'] == tenant_id or i.get('shared')
+                     or i.get('router:external')]
+            for key, values in query.items():
+                if key != 'fields':
+                    items = [i for i in items if str(i.get(key)) in values]
+            return 200, {}, {plural: items}
+        if method == 'POST' and len(parts) == 1:
+            data = json.loads(body)
+            many = plural in data
+            created = [self._neutron_create(plural, item, tenant_id) for item in (data[plural] if many else [data[single]])]
+            return 201, {}, {plural: created} if many else {single: created[0]}
+        item = store.get(parts[1])
+        if item is None or (item['tenant_id'] != tenant_id and not item.get('shared')):
+            raise FakeError(404, "%s %s could not be found"% (single, parts[1]))
+        if method == 'GET':
+            return 200, {}, {single: item}
+        if method == 'PUT' and plural == 'routers' and len(parts) == 3:
+            data = json.loads(body)
+            if parts[2] == 'add_router_interface':
+                return 200, {}, self._add_interface(item, data, tenant_id)
+            if parts[2] == 'remove_router_interface':
+                return 200, {}, self._remove_interface(item, data)
+        if method == 'DELETE':
+            self._neutron_delete(plural, item)
+            return 204, {}, None
+        raise FakeError(405, "Method not allowed")
+
+    def _neutron_create(self, plural, data, tenant_id):
+        item = dict(data)
+        item.setdefault('tenant_id', tenant_id)
+        item['id'] = str(uuid.uuid4())
+        if plural == 'networks':
+            item.update({'status': 'ACTIVE', 'subnets': [], 'shared': data.get('shared', False),
+                         'admin_state_up': data.get('admin_state_up', True), 'router:external': False})
+        elif plural == 'subnets':
+            network = self.networks.get(data.get('network_id'))
+            if network is None:
+                raise FakeError(404, "Network %s could not be found"% data.get('network_id'))
+            network['subnets'].append(item['id'])
+            item.setdefault('enable_dhcp', True)
+            item.setdefault('allocation_pools', [])
+        elif plural == 'routers':
+            item.update({'status': 'ACTIVE', 'external_gateway_info': data.get('external_gateway_info'),
+                         'admin_state_up': data.get('admin_state_up', True)})
+        elif plural == 'ports':
+            item.update({'status': 'ACTIVE', 'device_owner': data.get('device_owner', ''),
+                         'device_id': data.get('device_id', ''), 'fixed_ips': data.get('fixed_ips', [])})
+        {'networks': self.networks, 'subnets': self.subnets,
+         'routers': self.routers, 'ports': self.ports}[plural][item['id']] = item
+        return item
+
+    def _add_interface(self, router, data, tenant_id):
+        subnet = self.subnets.get(data.get('subnet_id'))
+        if subnet is None:
+            raise FakeError(404, "Subnet %s could not be found"% data.get('subnet_id'))
+        for p in self.ports.values():
+            if p['device_id'] == router['id'] and p['fixed_ips'][0]['subnet_id'] == subnet['id']:
+                raise FakeError(400, "Router already has a port on subnet %s"% subnet['id'])
+        port = self._neutron_create('ports', {'network_id': subnet['network_id'],
+                                              'device_owner': 'network:router_interface',
+                                              'device_id': router['id'],
+                                              'fixed_ips': [{'subnet_id': subnet['id'],
+                                                             'ip_address': subnet.get('gateway_ip')}]}, tenant_id)
+        return {'id': router['id'], 'tenant_id': tenant_id, 'port_id': port['id'], 'subnet_id': subnet['id']}
+
+    def _remove_interface(self, router, data):
+        for p in self.ports.values():
+            if p['device_id'] != router['id'] or p['device_owner'] != 'network:router_interface':
+                continue
+            if p['id'] == data.get('port_id') or p['fixed_ips'][0]['subnet_id'] == data.get('subnet_id'):
+                del self.ports[p['id']]
+                return {'id': router['id'], 'port_id': p['id'], 'subnet_id': p['fixed_ips'][0]['subnet_id']}
+        raise FakeError(404, "Router %s has no such interface"% router['id'])
+
+    def _neutron_delete(self, plural, item):
+        in_use = []
+        if plural == 'routers':
+            in_use = [p for p in self.ports.values() if p['device_id'] == item['id']]
+        elif plural == 'subnets':
+            in_use = [p for p in self.ports.values() if p['fixed_ips'] and p['fixed_ips'][0]['subnet_id'] == item['id']]
+        elif plural == 'networks':
+            in_use = [p for p in self.ports.values() if p['network_id'] == item['id'] and p['device_owner'] != 'network:dhcp']
+            in_use += [s for s in self.servers.values() if item['id'] in s['networks']
+                       and self._server_status(s) is not None]
+        if in_use:
+            raise FakeError(409, "%s %s is still in use"% (plural[:-1], item['id']))
+        if plural == 'subnets':
+            network = self.networks.get(item['network_id'])
+            if network is not None:
+                network['subnets'].remove(item['id'])
+        if plural == 'networks':
+            for subnet_id in item['subnets']:
+                self.subnets.pop(subnet_id, None)
+        {'networks': self.networks, 'subnets': self.subnets,
+         'routers': self.routers, 'ports': self.ports}[plural].pop(item['id'])
+
+    #### Cinder v1
+
+    def _volume(self, method, parts, query, headers, body, token):
+        if parts[:1] == ['os-quota-sets'] and method == 'PUT':
+            return 200, {}, {'quota_set': json.loads(body)['quota_set']}
+        if parts[:1] != ['volumes']:
+            raise FakeError(404, "Not found")
+        tenant_id = token['tenant']['id']
+        if method == 'GET' and (len(parts) == 1 or parts[1] == 'detail'):
+            views = [self._volume_view(v) for v in self.volumes.values()
+                     if self._visible(v, token, query, 'project_id')]
+            views = [v for v in views if v is not None]
+            if 'metadata' in query:
+                # Like cinder, which reads the filter as a python literal
+                wanted = ast.literal_eval(query['metadata'][0])
+                views = [v for v in views if all(v['metadata'].get(k) == w for k, w in wanted.items())]
+            return 200, {}, {'volumes': views}
+        if method == 'POST' and len(parts) == 1:
+            data = json.loads(body)['volume']
+            if data.get('imageRef') and data['imageRef'] not in self.images:
+                raise FakeError(400, "Invalid image %s"% data['imageRef'])
+            v = {'id': str(uuid.uuid4()), 'tenant_id': tenant_id, 'size': int(data['size']),
+                 'display_name': data.get('display_name'), 'display_description': data.get('display_description'),
+                 'volume_type': data.get('volume_type'), 'snapshot_id': data.get('snapshot_id'),
+                 'metadata': data.get('metadata') or {}, 'availability_zone': 'nova',
+                 'image_id': data.get('imageRef'), 'created_at': _now(), 'deleted_at': None,
+                 'attached_to': None, 'error': random.random() < self.config['volume_error_rate']}
+            self.volumes[v['id']] = v
+            return 200, {}, {'volume': self._volume_view(v)}
+        v = self.volumes.get(parts[1])
+        view = self._volume_view(v) if v is not None and self._visible(v, token) else None
+        if view is None:
+            raise FakeError(404, "Volume %s could not be found"% parts[1])
+        if method == 'GET':
+            return 200, {}, {'volume': view}
+        if method == 'DELETE':
+            if view['status'] not in ('available', 'error'):
+                raise FakeError(400, "Volume status must be available or error, but is %s"% view['status'])
+            v['deleted_at'] = _now()
+            return 202, {}, None
+        raise FakeError(405, "Method not allowed")
+
+    #### Nova v1.1
+
+    def _compute(self, method, parts, query, headers, body, token):
+        collection = parts[0] if parts else ''
+        if collection == 'flavors' and method == 'GET':
+            flavors = sorted(self.flavors.values(), key=lambda f: f['id'])
+            if len(parts) > 1 and parts[1] != 'detail':
+                if parts[1] not in self.flavors:
+                    raise FakeError(404, "Flavor %s could not be found"% parts[1])
+                return 200, {}, {'flavor': dict(self.flavors[parts[1]], links=[])}
+            if len(parts) == 1:
+                return 200, {}, {'flavors': [{'id': f['id'], 'name': f['name'], 'links': []} for f in flavors]}
+            return 200, {}, {'flavors': [dict(f, links=[]) for f in flavors]}
+        if collection == 'images' and method == 'GET':
+            images = [{'id': i['id'], 'name': i['name'], 'status': i['status'].upper(), 'links': [],
+                       'metadata': {}} for i in self.images.values()]
+            return 200, {}, {'images': images}
+        if collection == 'os-keypairs':
+            return self._keypairs(method, parts, body, token)
+        if collection == 'os-volumes_boot' and method == 'POST' and len(parts) == 1:
+            # Where novaclient sends boots with a block_device_mapping
+            return 202, {}, self._create_servers(json.loads(body)['server'], token)
+        if collection != 'servers':
+            raise FakeError(404, "Not found")
+        if method == 'GET' and (len(parts) == 1 or parts[1] == 'detail'):
+            views = [self._server_view(s) for s in self.servers.values() if self._visible(s, token, query)]
+            views = [v for v in views if v is not None]
+            if 'name' in query:
+                pattern = re.compile(query['name'][0])
+                views = [v for v in views if pattern.search(v['name'])]
+            return 200, {}, {'servers': views}
+        if method == 'POST' and len(parts) == 1:
+            return 202, {}, self._create_servers(json.loads(body)['server'], token)
+        s = self.servers.get(parts[1])
+        view = self._server_view(s) if s is not None and self._visible(s, token) else None
+        if view is None:
+            raise FakeError(404, "Instance %s could not be found"% parts[1])
+        if method == 'GET':
+            return 200, {}, {'server': view}
+        if method == 'DELETE':
+            if s['deleted_at'] is None:
+                s['deleted_at'] = _now()
+            return 204, {}, None
+        raise FakeError(405, "Method not allowed")
+
+    def _create_servers(self, data, token):
+        image_id = data.get('imageRef')
+        if image_id and image_id not in self.images:
+            raise FakeError(400, "Can not find requested image")
+        if data.get('flavorRef') not in self.flavors:
+            raise FakeError(400, "Flavor %s could not be found"% data.get('flavorRef'))
+        networks = [n.get('uuid') for n in data.get('networks', [])]
+        for n in networks:
+            if n not in self.networks:
+                raise FakeError(400, "Network %s could not be found"% n)
+        volumes = []
+        mappings = [m.get('volume_id') for m in data.get('block_device_mapping', [])]
+        mappings += [m.get('uuid') for m in data.get('block_device_mapping_v2', [])
+                     if m.get('source_type') == 'volume']
+        for volume_id in mappings:
+            v = self.volumes.get(volume_id)
+            if v is None or self._volume_status(v) != 'available':
+                raise FakeError(400, "Volume %s is not available"% volume_id)
+            volumes.append(v)
+        count = int(data.get('max_count', 1))
+        first = None
+        for n in range(count):
+            name = data['name'] if count == 1 else '%s-%d'% (data['name'], n + 1)
+            s = {'id': str(uuid.uuid4()), 'name': name, 'tenant_id': token['tenant']['id'],
+                 'user_id': token['user']['id'], 'key_name': data.get('key_name'),
+                 'metadata': data.get('metadata') or {}, 'image_id': image_id,
+                 'flavor_id': data['flavorRef'], 'networks': networks, 'created_at': _now(),
+                 'deleted_at': None, 'error': random.random() < self.config['server_error_rate']}
+            self.servers[s['id']] = s
+            first = first or s
+        for v in volumes:
+            v['attached_to'] = first['id']
+        return {'server': {'id': first['id'], 'adminPass': uuid.uuid4().hex[:12], 'links': []}}
+
+    def _keypairs(self, method, parts, body, token):
+        user_id = token['user']['id']
+        keypairs = self.keypairs.setdefault(user_id, {})
+        if method == 'GET' and len(parts) == 1:
+            return 200, {}, {'keypairs': [{'keypair': k} for k in keypairs.values()]}
+        if method == 'POST':
+            data = json.loads(body)['keypair']
+            if data['name'] in keypairs:
+                raise FakeError(409, "Key pair %s already exists"% data['name'])
+            k = {'name': data['name'], 'public_key': data.get('public_key', ''),
+                 'fingerprint': hashlib.md5(data.get('public_key', '')).hexdigest()}
+            keypairs[k['name']] = k
+            return 200, {}, {'keypair': k}
+        if method == 'DELETE' and len(parts) == 2:
+            if keypairs.pop(parts[1], None) is None:
+                raise FakeError(404, "Keypair %s not found"% parts[1])
+            return 202, {}, None
+        raise FakeError(405, "Method not allowed")
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # Concurrent benchmarks would otherwise stall on SYN retries
+    request_queue_size = 512
+
+    def __init__(self, *args, **kwargs):
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        """Hang up on kept-alive clients so their handler threads finish"""
+        with self.connections_lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Turn HTTP requests into FakeStack.handle calls"""
+    protocol_version = 'HTTP/1.1'
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        """Read the request body, spooling image uploads to a temporary file"""
+        upload = self.path.startswith('/image/') and self.command in ('POST', 'PUT')
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = self._read_chunks()
+        else:
+            length = int(self.headers.get('content-length') or 0)
+            chunks = self._read_length(length)
+        if not upload:
+            return ''.join(chunks)
+        f = tempfile.TemporaryFile()
+        size = 0
+        checksum = hashlib.md5()
+        for chunk in chunks:
+            f.write(chunk)
+            checksum.update(chunk)
+            size += len(chunk)
+        if not size:
+            f.close()
+            return None
+        f.seek(0)
+        return f, size, checksum.hexdigest()
+
+    def _read_length(self, length):
+        while length > 0:
+            chunk = self.rfile.read(min(length, 65536))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+    def _read_chunks(self):
+        while True:
+            size = int(self.rfile.readline().split(';')[0].strip() or '0', 16)
+            if size == 0:
+                self.rfile.readline()
+                break
+            yield self.rfile.read(size)
+            self.rfile.readline()
+
+    def _dispatch(self):
+        url = urlparse.urlparse(self.path)
+        headers = dict((k.lower(), v) for k, v in self.headers.items())
+        try:
+            body = self._read_body()
+            status, extra, result = self.fake.handle(self.command, url.path, urlparse.parse_qs(url.query),
+                                                     headers, body)
+        except FakeError as e:
+            status, extra, result = e.status, {}, {'error': {'code': e.status, 'message': str(e)}}
+        except (KeyError, ValueError) as e:
+            status, extra, result = 400, {}, {'error': {'code': 400, 'message': "Malformed request: %s"% e}}
+        self.send_response(status)
+        for k, v in extra.items():
+            self.send_header(k, v)
+        if hasattr(result, 'read'):
+            # Stream image data back in chunks
+            result.seek(0, os.SEEK_END)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(result.tell()))
+            self.end_headers()
+            result.seek(0)
+            while True:
+                chunk = result.read(65536)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+            return
+        data = '' if result is None else json.dumps(result)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _dispatch
+
+def load_config(path):
+    """Read FakeStack settings from a JSON file"""
+    with open(path) as f:
+        return json.load(f)
+
+def usage():
+    """ Print usage information for command-line use """
+    msg = """
+Usage: fakestack.py [OPTION]...
+  Serve a fake OpenStack cloud for teapot to run against:
+
+  -a    Address to listen on (defaults to 127.0.0.1)
+  -P    Port to listen on (defaults to 5000)
+  -c    JSON file of settings overriding fakestack.default_config
+
+Example:
+  fakestack.py -P 5000 &
+  teapot.py -k http://127.0.0.1:5000/identity/v2.0 load
+"""
+    print msg
+
+if __name__ == '__main__':
+    host, port, config = '127.0.0.1', 5000, None
+    opts, args = getopt.getopt(sys.argv[1:], 'a:P:c:h')
+    for o, a in opts:
+        if o == "-h":
+            usage()
+            sys.exit()
+        elif o == "-a":
+            host = a
+        elif o == "-P":
+            port = int(a)
+        elif o == "-c":
+            config = load_config(a)
+    fake = FakeStack(host, port, config).start()
+    print "Serving a fake cloud with keystone at %s"% fake.keystone_url
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
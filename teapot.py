@@ -19,14 +19,43 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 
 #### Imports
 
+import time
+started = time.time()
 import unittest
-import os, uuid, time, getopt, sys
-import keystoneclient.v2_0.client as ksclient
-from keystoneclient.exceptions import *
-import glanceclient.v1.client as glanceclient
-import neutronclient.v2_0.client as neutronclient
-import cinderclient.v1.client as cinderclient
-import novaclient.v1_1.client as novaclient
+import os, uuid, getopt, sys, random, json, re, urllib, importlib, hashlib, resource, glob
+import multiprocessing, multiprocessing.pool, multiprocessing.util, threading, types, httplib, csv, ssl, traceback
+import collections, heapq, itertools, Queue, contextlib, fcntl, errno
+
+# Seconds spent importing each client library, filled in as they are first used
+import_timings = {}
+
+class LazyModule(object):
+    """Stand-in for a module that is only imported the first time it is used
+    
+    The client libraries are slow to import, so only the ones the selected
+    suites actually call are loaded.
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+    
+    def _load(self):
+        if self._module is None:
+            start = time.time()
+            self.__dict__['_module'] = importlib.import_module(self._name)
+            import_timings[self._name] = time.time() - start
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+ksclient = LazyModule('keystoneclient.v2_0.client')
+ksexceptions = LazyModule('keystoneclient.exceptions')
+glanceclient = LazyModule('glanceclient.v1.client')
+neutronclient = LazyModule('neutronclient.v2_0.client')
+cinderclient = LazyModule('cinderclient.v1.client')
+novaclient = LazyModule('novaclient.v1_1.client')
+requests = LazyModule('requests')
 
 #### Defs
 
@@ -38,13 +67,98 @@ test_tenant='unittest tenant'
 test_user='unittest'
 test_timeout=300
 glance_image='cirros'
+# Flavor to boot test instances with; None picks the second flavor nova lists
+nova_flavor=None
+# Number of images glance returns per page when looking images up by name
+image_page_size=20
+# Re-authenticate cached tokens this many seconds before they expire
+token_stale_duration=300
+# First and largest interval (in seconds) between status polls
+poll_interval=0.2
+poll_max_interval=5.0
+# Test subnets are carved out of this /16; parallel workers each get their own
+subnet_prefix='192.168'
+# Number of worker processes used to run the tests
+workers=1
+# Number of deletes issued at once against each service within a teardown tier
+teardown_concurrency=10
+# Number of router interfaces attached at once when building a topology
+topology_concurrency=10
+# Number of networks in the neutron scale test (0 skips it)
+scale_networks=0
+# Number of servers.create calls issued at once by the boot pipeline
+boot_concurrency=10
+# Boot all the servers on a network with a single min_count/max_count request
+boot_multi_create=False
+# Record the latency, HTTP status and response size of every API call
+instrument_clients=True
+# Write the per-operation API call report here at the end of the run (.csv or .json)
+api_report_file=None
+# Send every client's calls over one pooled keep-alive HTTP session and hand
+# cinder and nova the cached tokens instead of letting them log in themselves
+shared_transport=True
+
+# Scenarios that load mode picks from, and how often to pick each one
+load_scenarios = {'volume': ('TestCinder', 'test_001_create_volume'),
+                  'network': ('TestNeutron', 'test_002_create_network_with_subnet'),
+                  'instance': ('TestNova', 'test_001_launch_single_instance')}
+load_mix = {'volume': 1, 'network': 1, 'instance': 1}
+# Size in MB of the images TestGlance pushes through glance, and how many
+# are transferred at once (0 MB, the default, skips the data-plane test)
+image_transfer_size=0
+image_transfers=1
+image_chunk_size=65536
+# Number of volumes TestCinder creates at once (0 skips the fan-out tests) and their size in GB
+volume_fanout=0
+volume_fanout_size=1
+# Most blocking calls the event loop has in flight against each service at once
+service_concurrency={'keystone': 10, 'glance': 4, 'neutron': 10, 'cinder': 50, 'nova': 20}
+# Number of users and tenants the identity benchmark creates
+identity_users=100
+identity_tenants=10
 
-# Whether or not to test individual components
+# Load mode runs for this many seconds, or this many scenarios in total
+load_duration=None
+load_iterations=None
+# Width in seconds of each line of the load report's throughput over time
+load_interval=10
+# JSON file of fakestack settings (latencies, failures, build times) for bench mode
+fake_config=None
+
+# Every resource a run creates is tagged with the run id and recorded in a
+# manifest in this directory until it is deleted; 'sweep' cleans up after
+# runs that left their manifest behind
+run_id='%s-%s'% (time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:6])
+run_manifest_dir=os.path.expanduser('~/.teapot_runs')
+# Manifests written to within this many seconds may belong to a live run and aren't swept
+sweep_min_age=600
+
+# Manual mode keeps its environments in this file so later sessions can
+# reattach to them, and keeps this many idle ones built and ready
+env_state_file=os.path.expanduser('~/.teapot_environments.json')
+env_pool_size=1
+
+# Topology built by TestNova.test_003_multivm_with_networks and manual mode.
+# Networks without an octet get the next free /24 from subnet_range().
+multivm_topology = {
+    'networks': [{'name': 'nova_test_003_network1', 'subnet': 'nova_test_003_subnet1', 'octet': 252, 'instances': 3},
+                 {'name': 'nova_test_003_network2', 'subnet': 'nova_test_003_subnet2', 'octet': 253, 'instances': 3},
+                 {'name': 'nova_test_003_network3', 'subnet': 'nova_test_003_subnet3', 'octet': 254, 'instances': 3}],
+    'routers': [{'name': 'nova_test_003_router1', 'networks': ['nova_test_003_network1', 'nova_test_003_network2']}],
+}
+# Rough duration of each suite in seconds, used to schedule the slowest first
+expected_durations={'TestKeystone': 5, 'TestGlance': 5, 'TestNeutron': 20,
+                    'TestCinder': 90, 'TestNova': 170}
+
+# Whether or not to test individual components (see also -c)
 TEST_KEYSTONE=True
 TEST_GLANCE=True
 TEST_NEUTRON=True
 TEST_CINDER=True
 TEST_NOVA=True
+components = ['keystone', 'glance', 'neutron', 'cinder', 'nova']
+# When the first test started, for the startup report
+first_test = None
 
 class TeapotException(Exception):
     pass
@@ -52,28 +166,2237 @@ class TeapotException(Exception):
 class TimeoutException(Exception):
     pass
 
+def subnet_range(octet):
+    """Return the (cidr, gateway_ip) of the /24 numbered octet in this run's subnet range"""
+    base = '%s.%d'% (subnet_prefix, octet)
+    return '%s.0/24'% base, '%s.1'% base
+
+class ApiMetrics(object):
+    """Latency, HTTP status and response size of every instrumented API call"""
+    def __init__(self):
+        self.samples = {}
+    
+    def record(self, operation, status, latency, size):
+        self.samples.setdefault(operation, []).append((latency, status, size))
+    
+    def drain(self):
+        """Return and forget the samples recorded so far"""
+        samples, self.samples = self.samples, {}
+        return samples
+    
+    def merge(self, samples):
+        for operation, values in samples.items():
+            self.samples.setdefault(operation, []).extend(values)
+    
+    def calls(self):
+        return sum(len(v) for v in self.samples.values())
+    
+    def summary(self):
+        """Return a row of counts and latency percentiles for each operation"""
+        rows = []
+        for operation, values in sorted(self.samples.items()):
+            latencies = [v[0] for v in values]
+            errors = [v for v in values if v[1] == 'error' or (isinstance(v[1], int) and v[1] >= 400)]
+            statuses = {}
+            for v in values:
+                statuses[v[1]] = statuses.get(v[1], 0) + 1
+            rows.append({'operation': operation,
+                         'service': operation.split('.')[0],
+                         'count': len(values),
+                         'errors': len(errors),
+                         'statuses': ' '.join('%s:%d'% i for i in sorted(statuses.items())),
+                         'mean': sum(latencies) / len(latencies),
+                         'p50': percentile(latencies, 50),
+                         'p95': percentile(latencies, 95),
+                         'p99': percentile(latencies, 99),
+                         'max': max(latencies),
+                         'bytes': sum(v[2] for v in values)})
+        return rows
+    
+    def write(self, path):
+        """Write the summary to path as CSV if it ends in .csv, JSON otherwise"""
+        rows = self.summary()
+        fields = ['operation', 'service', 'count', 'errors', 'statuses', 'mean', 'p50', 'p95', 'p99', 'max', 'bytes']
+        with open(path, 'w') as f:
+            if path.endswith('.csv'):
+                writer = csv.DictWriter(f, fields)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump(rows, f, indent=2)
+    
+    def report(self):
+        return "API: %d calls across %d operations"% (self.calls(), len(self.samples))
+
+api_metrics = ApiMetrics()
+
+class ConnectionStats(object):
+    """Per host counts of requests, new connections, TLS handshakes and token requests"""
+    def __init__(self):
+        self.hosts = {}
+        self.lock = threading.Lock()
+    
+    def record(self, host, new, tls, auth):
+        with self.lock:
+            counts = self.hosts.setdefault(host, [0, 0, 0, 0])
+            counts[0] += 1
+            counts[1] += new
+            counts[2] += tls
+            counts[3] += auth
+    
+    def drain(self):
+        with self.lock:
+            hosts, self.hosts = self.hosts, {}
+        return hosts
+    
+    def merge(self, hosts):
+        for host, counts in hosts.items():
+            merged = self.hosts.setdefault(host, [0, 0, 0, 0])
+            for n, value in enumerate(counts):
+                merged[n] += value
+    
+    def report(self):
+        totals = [sum(counts[n] for counts in self.hosts.values()) for n in range(4)]
+        calls, connections, handshakes, auths = totals
+        lines = ["Connections: %d requests over %d connections (%d reused), %d TLS handshakes, %d token requests, %s"%
+                 (calls, connections, calls - connections, handshakes, auths,
+                  'shared session' if shared_transport else 'per client sessions')]
+        for host, counts in sorted(self.hosts.items()):
+            lines.append("  %-24s %6d requests %5d connections %5d TLS handshakes %5d token requests"% ((host,) + tuple(counts)))
+        return '\n'.join(lines)
+
+connection_stats = ConnectionStats()
+
+# The instrumented call in progress on each thread, filled in by the HTTP hook
+_current_call = threading.local()
+
+def _install_http_hook():
+    """Patch httplib so responses are attributed to the instrumented call in progress
+    
+    All of the clients end up in httplib.HTTPConnection.getresponse whether
+    they use requests, httplib2 or httplib directly.  Only the headers are
+    looked at, so streamed bodies are left alone.  Every response is also
+    counted in connection_stats, along with whether it needed a new
+    connection (and TLS handshake) or reused a kept-alive one.
+    """
+    if getattr(httplib.HTTPConnection.getresponse, 'teapot_hook', False):
+        return
+    putrequest = httplib.HTTPConnection.putrequest
+    def hooked_putrequest(self, method, url, *args, **kwargs):
+        self._teapot_request = (method, url)
+        return putrequest(self, method, url, *args, **kwargs)
+    getresponse = httplib.HTTPConnection.getresponse
+    def hooked(self, *args, **kwargs):
+        # getresponse closes the socket when the server won't keep it alive
+        sock = self.sock
+        response = getresponse(self, *args, **kwargs)
+        new = sock is not getattr(self, '_teapot_sock', None)
+        self._teapot_sock = sock
+        method, url = getattr(self, '_teapot_request', (None, ''))
+        connection_stats.record('%s:%s'% (self.host, self.port), new, new and isinstance(sock, ssl.SSLSocket),
+                                method == 'POST' and url.split('?')[0].rstrip('/').endswith('/tokens'))
+        call = getattr(_current_call, 'record', None)
+        if call is not None:
+            call['status'] = response.status
+            try:
+                call['size'] += int(response.getheader('content-length') or 0)
+            except ValueError:
+                pass
+        return response
+    hooked.teapot_hook = True
+    httplib.HTTPConnection.putrequest = hooked_putrequest
+    httplib.HTTPConnection.getresponse = hooked
+
+def _timed(func, operation):
+    """Wrap func so each call is recorded in api_metrics under operation"""
+    def call(*args, **kwargs):
+        if getattr(_current_call, 'record', None) is not None:
+            # Already inside an instrumented call, which gets the credit
+            return func(*args, **kwargs)
+        record = {'status': None, 'size': 0}
+        _current_call.record = record
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            _current_call.record = None
+            api_metrics.record(operation, record['status'] or 'error', time.time() - start, record['size'])
+            raise
+        _current_call.record = None
+        elapsed = time.time() - start
+        if isinstance(result, types.GeneratorType):
+            return _timed_iter(result, operation, record, elapsed)
+        api_metrics.record(operation, record['status'], elapsed, record['size'])
+        return result
+    call.__name__ = getattr(func, '__name__', operation)
+    return call
+
+def _timed_iter(generator, operation, record, elapsed):
+    """Record a paginated listing once it has been consumed"""
+    try:
+        while True:
+            _current_call.record = record
+            start = time.time()
+            try:
+                item = next(generator)
+            except StopIteration:
+                break
+            finally:
+                _current_call.record = None
+                elapsed += time.time() - start
+            yield item
+    finally:
+        api_metrics.record(operation, record['status'], elapsed, record['size'])
+
+class Instrumented(object):
+    """Proxy for a client, or one of its managers, that times every call made through it"""
+    # Attributes that are client objects but don't talk to the API
+    passthrough = ('service_catalog', 'auth_ref', 'client', 'http_client', 'httpclient')
+    
+    def __init__(self, target, operation):
+        self._target = target
+        self._operation = operation
+    
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name.startswith('_') or name in self.passthrough or isinstance(value, (type, types.ClassType)):
+            return value
+        operation = '%s.%s'% (self._operation, name)
+        if callable(value):
+            value = _timed(value, operation)
+        elif type(value).__module__.split('.')[0] in ('keystoneclient', 'glanceclient', 'neutronclient',
+                                                        'cinderclient', 'novaclient'):
+            value = Instrumented(value, operation)
+        else:
+            return value
+        # Keep the wrapper so the same bound call is handed out every time
+        self.__dict__[name] = value
+        return value
+
+class SharedTransport(object):
+    """One pooled, keep-alive connection adapter that every client sends its calls through
+    
+    Left alone, clients that call requests.request() set up a new session,
+    and with it a new connection and TLS handshake, for every call, and
+    clients that keep their own session only reuse connections among their
+    own calls.  The module level requests calls go through one shared
+    session instead, and the adapter behind it is mounted on the session
+    each client keeps, so they all draw on the same connection pools.  The
+    clients keep their own sessions, which carry their auth headers and TLS
+    settings.  There is a pool per service endpoint, each large enough for
+    the most calls the run has in flight against one service.  Clients
+    built on httplib or httplib2 (neutron) keep their own connections.
+    """
+    # Where the client libraries keep their requests session
+    session_attributes = ('http', 'session', 'client.http', 'client.session',
+                          'http_client.session', 'httpclient.session', 'session.session')
+    
+    def __init__(self):
+        self.session = None
+        self.adapter = None
+    
+    def pool_size(self):
+        return max(service_concurrency.values() + [boot_concurrency, teardown_concurrency,
+                                                   topology_concurrency, image_transfers])
+    
+    def _adopt(self, session):
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+    
+    def start(self):
+        """Create the adapter and shared session and route the module level requests calls through it"""
+        if self.session is not None:
+            return
+        # Count connections from before any client is built
+        _install_http_hook()
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=len(service_concurrency),
+                                                     pool_maxsize=self.pool_size())
+        self.session = requests.Session()
+        self._adopt(self.session)
+        session = self.session
+        def request(method, url, **kwargs):
+            return session.request(method=method, url=url, **kwargs)
+        # Patch the real module, requests.get() and friends look request up in requests.api
+        module = importlib.import_module('requests')
+        module.request = module.api.request = request
+    
+    def reset(self):
+        """Give a forked worker its own connections rather than its parent's"""
+        if self.adapter is not None:
+            # Every session the adapter is mounted on picks up the new pools
+            self.adapter.init_poolmanager(len(service_concurrency), self.pool_size())
+    
+    def share(self, client):
+        """Mount the shared adapter on any requests session the client keeps"""
+        self.start()
+        for path in self.session_attributes:
+            names = path.split('.')
+            owner = client
+            for name in names[:-1]:
+                owner = getattr(owner, name, None)
+            current = getattr(owner, names[-1], None)
+            if isinstance(current, requests.Session) and current is not self.session:
+                self._adopt(current)
+
+transport = SharedTransport()
+
+def instrument(client, service):
+    """Wrap client so every call through it is recorded in api_metrics"""
+    _install_http_hook()
+    if shared_transport:
+        transport.share(client)
+    if not instrument_clients:
+        return client
+    return Instrumented(client, service)
+
+@contextlib.contextmanager
+def _no_completion_cache(*args, **kwargs):
+    yield
+
+def without_completion_cache(client):
+    """Turn off the name completion cache of a cinder or nova client's managers
+    
+    While a create or list is in progress the manager keeps the open cache
+    file in an attribute and deletes it afterwards, so concurrent calls
+    through one client fail with AttributeError: _human_id_cache.
+    """
+    for manager in vars(client).values():
+        if callable(getattr(manager, 'completion_cache', None)):
+            manager.completion_cache = _no_completion_cache
+    return client
+
+def token_client(factory, service_type, username, password, tenant_name):
+    """Build a cinder or nova client, without its completion cache, that starts out with the cached token
+    
+    The clients only log in on their own when they have no token or
+    endpoint, or when the token they were handed is rejected.
+    """
+    client = without_completion_cache(factory(username, password, tenant_name, keystone_url))
+    if shared_transport:
+        client.client.auth_token = credentials.token(username, password, tenant_name)
+        client.client.management_url = credentials.url_for(service_type, username=username, password=password,
+                                                           tenant_name=tenant_name)
+    return client
+
+class CredentialCache(object):
+    """Run-wide cache of authenticated keystone clients keyed by (user, tenant)
+
+    Tokens and service catalog lookups are handed out from the cache and a
+    fresh password authentication is only done when the cached token is
+    about to expire or the password for the user has changed.
+    """
+    def __init__(self, stale_duration=None):
+        self.stale_duration = stale_duration
+        self._clients = {}
+        self._urls = {}
+        self.auths = 0
+        self.saved = 0
+    
+    def _expiring(self, client):
+        stale = self.stale_duration
+        if stale is None:
+            stale = token_stale_duration
+        auth_ref = getattr(client, 'auth_ref', None)
+        if auth_ref is None:
+            return False
+        return auth_ref.will_expire_soon(stale_duration=stale)
+    
+    def client(self, username, password, tenant_name):
+        """Return an authenticated keystone client for the user and tenant"""
+        key = (username, tenant_name)
+        entry = self._clients.get(key)
+        if entry is not None and entry[0] == password and not self._expiring(entry[1]):
+            self.saved += 1
+            return entry[1]
+        # keystoneclient logs in as soon as it is built, so the login has to be
+        # counted, and sent over the shared session, from the start
+        _install_http_hook()
+        if shared_transport:
+            transport.start()
+        c = instrument(ksclient.Client(auth_url=keystone_url,
+                                       username=username,
+                                       password=password,
+                                       tenant_name=tenant_name), 'keystone')
+        self.auths += 1
+        self.forget(username, tenant_name)
+        self._clients[key] = (password, c)
+        return c
+    
+    def admin(self):
+        """Return the keystone client for the admin user"""
+        return self.client(admin_user, admin_pass, admin_tenant)
+    
+    def token(self, username, password, tenant_name):
+        return self.client(username, password, tenant_name).auth_token
+    
+    def url_for(self, service_type, endpoint_type='publicURL', username=None, password=None, tenant_name=None):
+        """Look up an endpoint in the service catalog, defaulting to the admin's catalog"""
+        if username is None:
+            username, password, tenant_name = admin_user, admin_pass, admin_tenant
+        c = self.client(username, password, tenant_name)
+        key = (username, tenant_name, service_type, endpoint_type)
+        if key not in self._urls:
+            self._urls[key] = c.service_catalog.url_for(service_type=service_type,
+                                                        endpoint_type=endpoint_type)
+        return self._urls[key]
+    
+    def forget(self, username, tenant_name):
+        """Drop the cached token and catalog entries for a user, e.g. once it is deleted"""
+        self._clients.pop((username, tenant_name), None)
+        for key in self._urls.keys():
+            if key[:2] == (username, tenant_name):
+                del self._urls[key]
+    
+    def report(self):
+        return "Keystone: %d authentications, %d saved by the credential cache"% (self.auths, self.saved)
+
+credentials = CredentialCache()
+
+# Reports from tests that are printed at the end of the run
+run_reports = []
+
+def percentile(values, p):
+    """Return the p-th percentile of values, interpolating between samples"""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+def latency_summary(values):
+    """Format the p50/p95/p99 and maximum of a list of latencies"""
+    if not values:
+        return "no samples"
+    return "p50 %.2fs  p95 %.2fs  p99 %.2fs  max %.2fs"% (percentile(values, 50), percentile(values, 95),
+                                                         percentile(values, 99), max(values))
+
+# Status used by StatusWaiter for resources that no longer show up in their listing
+GONE = 'gone'
+
+class StatusWaiter(object):
+    """Wait for many resources to reach a target status at once
+
+    Watched resources are grouped by the call used to list them, so each
+    poll costs one list call per service no matter how many resources are
+    being watched.  The delay between polls starts small and backs off
+    exponentially with some jitter, and every resource has its own deadline.
+    """
+    def __init__(self, interval=None, max_interval=None, backoff=1.5, jitter=0.2):
+        self.interval = interval or poll_interval
+        self.max_interval = max_interval or poll_max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.polls = 0
+        self.elapsed = {}
+        self._watches = []
+    
+    def watch(self, lister, resource_id, status, failures=None, timeout=None, observe=None):
+        """Watch the resource with resource_id in the results of lister()
+        
+        status may be a single status or a tuple of acceptable ones; use
+        GONE to wait for the resource to be deleted.  Reaching one of the
+        failures statuses ends the watch early.  observe, if given, is
+        called with every fresh copy of the resource and the poll time.
+        """
+        if isinstance(status, basestring):
+            status = (status,)
+        if failures is None:
+            failures = () if GONE in status else ('error',)
+        now = time.time()
+        self._watches.append({'lister': lister,
+                              'id': resource_id,
+                              'targets': set(x.lower() for x in status),
+                              'failures': set(x.lower() for x in failures),
+                              'started': now,
+                              'deadline': now + (timeout or test_timeout),
+                              'observe': observe,
+                              'status': None,
+                              'done': False})
+    
+    def _poll(self, lister, watches):
+        found = dict((r.id, r) for r in lister())
+        self.polls += 1
+        now = time.time()
+        for w in watches:
+            r = found.get(w['id'])
+            if r is None:
+                w['status'] = GONE
+            else:
+                w['status'] = str(r.status).lower()
+                if w['observe']:
+                    w['observe'](r, now)
+            if w['status'] in w['targets'] or w['status'] in w['failures']:
+                w['done'] = True
+                self.elapsed[w['id']] = now - w['started']
+    
+    def wait(self, what='resources', check=True):
+        """Poll until every watched resource has converged and return {id: status}
+        
+        Raises TimeoutException if any resource missed its deadline and
+        TeapotException if any resource ended up in a failure status, unless
+        check is False, in which case the last status seen is returned.
+        """
+        watches, self._watches = self._watches, []
+        pending = list(watches)
+        interval = self.interval
+        while pending:
+            by_lister = {}
+            for w in pending:
+                by_lister.setdefault(w['lister'], []).append(w)
+            for lister, group in by_lister.items():
+                self._poll(lister, group)
+            now = time.time()
+            pending = [w for w in pending if not w['done'] and w['deadline'] > now]
+            if not pending:
+                break
+            delay = min(interval, self.max_interval)
+            delay = delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            delay = min(delay, max(0, min(w['deadline'] for w in pending) - now))
+            time.sleep(delay)
+            interval = interval * self.backoff
+        if not check:
+            return dict((w['id'], w['status']) for w in watches)
+        timed_out = [w['id'] for w in watches if not w['done']]
+        if timed_out:
+            raise TimeoutException("Timeout waiting for %s: %s"% (what, ', '.join(timed_out)))
+        failed = ["%s (%s)"% (w['id'], w['status']) for w in watches if w['status'] in w['failures']]
+        if failed:
+            raise TeapotException("Failed waiting for %s: %s"% (what, ', '.join(failed)))
+        return dict((w['id'], w['status']) for w in watches)
+
+class RunManifest(object):
+    """Append-only record of the resources a run has created and not yet deleted
+    
+    Each line is a JSON 'add' or 'del' entry, so worker processes can all
+    append to the same file and a crashed run leaves behind exactly what it
+    didn't clean up.
+    """
+    def __init__(self, run, directory=None):
+        self.run_id = run
+        self.path = os.path.join(directory or run_manifest_dir, '%s.jsonl'% run)
+        self._lock = threading.Lock()
+    
+    def _write(self, entry):
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600)
+            try:
+                os.write(fd, json.dumps(entry) + '\n')
+            finally:
+                os.close(fd)
+    
+    def record(self, kind, resource_id, **detail):
+        """Note that a resource was created"""
+        entry = dict(detail, op='add', kind=kind, id=resource_id)
+        self._write(entry)
+    
+    def forget(self, kind, resource_id):
+        """Note that a resource is gone"""
+        self._write({'op': 'del', 'kind': kind, 'id': resource_id})
+    
+    def outstanding(self, tenant_id=None):
+        """Return the entries for resources that were created and not deleted, oldest first"""
+        if not os.path.exists(self.path):
+            return []
+        entries = {}
+        with open(self.path) as f:
+            for n, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                key = (entry['kind'], entry['id'])
+                if entry['op'] == 'add':
+                    entries[key] = (n, entry)
+                else:
+                    entries.pop(key, None)
+        found = [e for n, e in sorted(entries.values())]
+        if tenant_id is not None:
+            found = [e for e in found if e.get('tenant_id') == tenant_id]
+        return found
+    
+    def close(self):
+        """Remove the manifest if everything in it was deleted and return what is left"""
+        left = self.outstanding()
+        if not left and os.path.exists(self.path):
+            os.remove(self.path)
+        return left
+    
+    @classmethod
+    def leftovers(cls, directory=None):
+        """Return the manifests left behind by other runs"""
+        paths = glob.glob(os.path.join(directory or run_manifest_dir, '*.jsonl'))
+        runs = [os.path.basename(p)[:-len('.jsonl')] for p in sorted(paths)]
+        return [cls(r, directory) for r in runs if r != run_id]
+
+manifest = RunManifest(run_id)
+
+def run_tags():
+    """Metadata that marks a server, volume or image as created by this run"""
+    return {'teapot_run': run_id}
+
+class Return(Exception):
+    """Raised by a coroutine to finish with a value"""
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+class Call(object):
+    """Yielded by a coroutine to run a blocking client call on its service's worker pool
+    
+    func may be the dotted name of a client method, e.g. 'volumes.create',
+    to call it on the worker thread's own client for the service.
+    """
+    def __init__(self, service, func, *args, **kwargs):
+        self.service = service
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+class Sleep(object):
+    """Yielded by a coroutine to resume after seconds"""
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+class Watch(object):
+    """Yielded by a coroutine to resume with the resource's status once it is one of status or failures
+    
+    Resumes with the last status seen, which may be None, if the timeout
+    passes first.  Like a Call's func, lister may be a method name, and
+    search_opts, if given, are passed to it.  observe, if given, is called
+    on the loop's thread with every fresh copy of the resource and the poll
+    time.
+    """
+    def __init__(self, service, lister, resource_id, status, failures=None, timeout=None, observe=None,
+                 search_opts=None):
+        if isinstance(status, basestring):
+            status = (status,)
+        if failures is None:
+            failures = () if GONE in status else ('error',)
+        self.service = service
+        self.lister = lister
+        self.search_opts = search_opts
+        self.id = resource_id
+        self.targets = set(x.lower() for x in status)
+        self.failures = set(x.lower() for x in failures)
+        self.deadline = time.time() + (timeout or test_timeout)
+        self.observe = observe
+        self.status = None
+
+class Task(object):
+    """A coroutine running on an EventLoop; yield it, or a list of them, to wait for the result"""
+    def __init__(self, coroutine):
+        self.coroutine = coroutine
+        self.done = False
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+class EventLoop(object):
+    """Run many generator coroutines on one thread
+    
+    Coroutines yield what they are waiting for: a Call, Sleep, Watch, Task
+    or list of Tasks, and are resumed with its result.  Blocking client
+    calls go to a bounded worker pool per service, so thousands of
+    coroutines can be in flight without a thread each.  Status watches are
+    batched like StatusWaiter's, with one list call per poll for every
+    watch on the same lister.  run() is the synchronous entry point.
+    
+    Most of the clients can't be used from several threads at once, so
+    clients maps a service to a function that builds a client, and each
+    worker thread calls methods named by a Call or Watch on its own one.
+    """
+    def __init__(self, concurrency=None, interval=None, max_interval=None, backoff=1.5, jitter=0.2, clients=None):
+        self.concurrency = dict(service_concurrency)
+        self.concurrency.update(concurrency or {})
+        self.clients = clients or {}
+        self._local = threading.local()
+        self.interval = interval or poll_interval
+        self.max_interval = max_interval or poll_max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.polls = 0
+        self._pools = {}
+        self._ready = collections.deque()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._completed = Queue.Queue()
+        self._in_flight = 0
+        self._groups = {}
+    
+    def spawn(self, coroutine):
+        """Start coroutine and return its Task"""
+        task = Task(coroutine)
+        self._ready.append((task, None, None))
+        return task
+    
+    def run(self, coroutine):
+        """Run coroutine and everything it spawns until it finishes and return its result"""
+        main = self.spawn(coroutine)
+        try:
+            while not main.done:
+                self._run_once()
+        finally:
+            for pool in self._pools.values():
+                pool.close()
+                pool.join()
+            self._pools = {}
+        if main.error is not None:
+            raise main.error[0], main.error[1], main.error[2]
+        return main.result
+    
+    def _run_once(self):
+        if self._ready:
+            while self._ready:
+                self._step(*self._ready.popleft())
+            return
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            heapq.heappop(self._timers)[2]()
+        if self._ready:
+            return
+        if not self._in_flight and not self._timers:
+            raise TeapotException("Event loop has nothing left to wait for")
+        timeout = max(0, self._timers[0][0] - now) if self._timers else None
+        if not self._in_flight:
+            time.sleep(timeout)
+            return
+        try:
+            callback, result, error = self._completed.get(timeout=timeout)
+        except Queue.Empty:
+            return
+        self._in_flight -= 1
+        callback(result, error)
+        # Drain whatever else finished without blocking again
+        while True:
+            try:
+                callback, result, error = self._completed.get_nowait()
+            except Queue.Empty:
+                break
+            self._in_flight -= 1
+            callback(result, error)
+    
+    def _later(self, delay, callback):
+        heapq.heappush(self._timers, (time.time() + delay, next(self._sequence), callback))
+    
+    def _submit(self, service, func, args, kwargs, callback):
+        """Run func on the worker pool for service and hand its outcome to callback on the loop thread"""
+        if service not in self._pools:
+            self._pools[service] = multiprocessing.pool.ThreadPool(self.concurrency.get(service, 10))
+        completed = self._completed
+        def work():
+            try:
+                completed.put((callback, self._resolve(service, func)(*args, **kwargs), None))
+            except Exception:
+                completed.put((callback, None, sys.exc_info()))
+        self._in_flight += 1
+        self._pools[service].apply_async(work)
+    
+    def _resolve(self, service, func):
+        """Look a method name up on this worker thread's own client for service"""
+        if not isinstance(func, basestring):
+            return func
+        client = getattr(self._local, service, None)
+        if client is None:
+            client = self.clients[service]()
+            setattr(self._local, service, client)
+        for name in func.split('.'):
+            client = getattr(client, name)
+        return client
+    
+    def _step(self, task, value, error):
+        try:
+            if error is not None:
+                yielded = task.coroutine.throw(*error)
+            else:
+                yielded = task.coroutine.send(value)
+        except StopIteration:
+            self._finish(task, None, None)
+        except Return as r:
+            self._finish(task, r.value, None)
+        except Exception:
+            self._finish(task, None, sys.exc_info())
+        else:
+            self._wait(task, yielded)
+    
+    def _resume(self, task):
+        return lambda result, error: self._ready.append((task, result, error))
+    
+    def _finish(self, task, result, error):
+        task.done, task.result, task.error = True, result, error
+        for callback in task.callbacks:
+            callback(result, error)
+        task.callbacks = []
+    
+    def _wait(self, task, yielded):
+        if isinstance(yielded, Call):
+            self._submit(yielded.service, yielded.func, yielded.args, yielded.kwargs, self._resume(task))
+        elif isinstance(yielded, Sleep):
+            self._later(yielded.seconds, lambda: self._ready.append((task, None, None)))
+        elif isinstance(yielded, Watch):
+            self._watch(yielded, self._resume(task))
+        elif isinstance(yielded, Task):
+            self._join([yielded], lambda results, error: self._ready.append((task, results and results[0], error)))
+        elif isinstance(yielded, (list, tuple)):
+            self._join(list(yielded), self._resume(task))
+        else:
+            self._ready.append((task, None, (TeapotException, TeapotException("Can't wait for %r"% (yielded,)), None)))
+    
+    def _join(self, tasks, callback):
+        """Call callback with every task's result, or the first error, once they are all done"""
+        pending = [t for t in tasks if not t.done]
+        def check(result=None, error=None):
+            if [t for t in tasks if not t.done]:
+                return
+            errors = [t.error for t in tasks if t.error is not None]
+            callback([t.result for t in tasks], errors[0] if errors else None)
+        if not pending:
+            return check()
+        for t in pending:
+            t.callbacks.append(check)
+    
+    def _watch(self, watch, callback):
+        key = (watch.service, watch.lister, tuple(sorted((watch.search_opts or {}).items())))
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = {'watches': [], 'interval': self.interval, 'scheduled': False}
+        group['watches'].append((watch, callback))
+        if not group['scheduled']:
+            group['scheduled'] = True
+            self._later(self._delay(group), lambda: self._poll(key))
+    
+    def _delay(self, group):
+        delay = min(group['interval'], self.max_interval) * random.uniform(1 - self.jitter, 1 + self.jitter)
+        deadline = min(w.deadline for w, c in group['watches'])
+        return max(0, min(delay, deadline - time.time()))
+    
+    def _poll(self, key):
+        service, lister, search_opts = key
+        kwargs = {'search_opts': dict(search_opts)} if search_opts else {}
+        self._submit(service, lister, (), kwargs, lambda result, error: self._polled(key, result, error))
+    
+    def _polled(self, key, result, error):
+        group = self._groups[key]
+        self.polls += 1
+        now = time.time()
+        found = None
+        if error is None:
+            found = dict((r.id, r) for r in result)
+        waiting = []
+        for watch, callback in group['watches']:
+            if found is not None:
+                r = found.get(watch.id)
+                if r is None:
+                    watch.status = GONE
+                else:
+                    watch.status = str(r.status).lower()
+                    if watch.observe:
+                        watch.observe(r, now)
+            if watch.status in watch.targets or watch.status in watch.failures or watch.deadline <= now:
+                callback(watch.status, None)
+            else:
+                waiting.append((watch, callback))
+        group['watches'] = waiting
+        group['interval'] *= self.backoff
+        if waiting:
+            self._later(self._delay(group), lambda: self._poll(key))
+        else:
+            group['scheduled'] = False
+            group['interval'] = self.interval
+
+def _is_not_found(e):
+    """Whether an exception from one of the clients means the resource doesn't exist"""
+    for attr in ('status_code', 'http_status', 'code'):
+        if getattr(e, attr, None) == 404:
+            return True
+    return False
+
+# Running totals of teardown work per tier: {tier: [teardowns, resources, seconds]}
+teardown_totals = {}
+
+class TenantTeardown(object):
+    """Delete a tenant's servers, volumes and network artifacts tier by tier
+    
+    Resources are layered by what has to be gone before they can be
+    deleted: servers first, then volumes and router interfaces, then
+    routers and subnets and finally networks.  Everything in a tier is
+    deleted concurrently on an EventLoop, and the tier is confirmed gone
+    before moving on.  Anything that couldn't be deleted is recorded in
+    leaks.  neutron, nova and cinder are functions that build a client, so
+    that every worker thread has its own.
+    """
+    # Kinds of resource and the kinds that must be deleted before them
+    DEPENDS = {'server': (),
+               'volume': ('server',),
+               'interface': ('server',),
+               'router': ('interface',),
+               'subnet': ('interface', 'server'),
+               'network': ('subnet', 'server')}
+    # Service and lister of the kinds whose deletes are watched until they are gone
+    LISTERS = {'server': ('nova', 'servers.list'),
+               'volume': ('cinder', 'volumes.list')}
+    # The search option and attribute that give the tenant of a server or volume
+    OWNERS = {'server': ('tenant_id', 'tenant_id'),
+              'volume': ('project_id', 'os-vol-tenant-attr:tenant_id')}
+    # Set when the clients are the admin's, so that servers and volumes are
+    # listed across all tenants and filtered down to tenant_id
+    all_tenants = False
+    
+    def __init__(self, neutron=None, nova=None, cinder=None, tenant_id=None):
+        self.clients = dict((service, factory) for service, factory in
+                            (('neutron', neutron), ('nova', nova), ('cinder', cinder)) if factory)
+        self.tenant_id = tenant_id
+        self.resources = dict((kind, {}) for kind in self.DEPENDS)
+        self.timings = []
+        self.leaks = []
+        self.manifest = manifest
+    
+    @classmethod
+    def tiers(cls):
+        """Return the kinds of resource grouped into tiers in deletion order"""
+        levels = {}
+        def level(kind):
+            if kind not in levels:
+                levels[kind] = 1 + max([level(d) for d in cls.DEPENDS[kind]] or [-1])
+            return levels[kind]
+        for kind in cls.DEPENDS:
+            level(kind)
+        return [sorted(k for k in levels if levels[k] == n) for n in range(max(levels.values()) + 1)]
+    
+    def add(self, kind, resource_id, **detail):
+        """Schedule a single resource for deletion and record it in the run manifest"""
+        if resource_id not in self.resources[kind]:
+            self.manifest.record(kind, resource_id, tenant_id=self.tenant_id, **detail)
+        self.resources[kind][resource_id] = detail
+    
+    def restore(self, entries):
+        """Schedule the resources in run manifest entries for deletion"""
+        for entry in entries:
+            if entry['kind'] in self.resources:
+                detail = dict((k, v) for k, v in entry.items() if k not in ('op', 'kind', 'id', 'tenant_id'))
+                self.resources[entry['kind']][entry['id']] = detail
+        return self
+    
+    def discover(self):
+        """Schedule everything the clients can see in the tenant for deletion"""
+        filters = {}
+        if self.tenant_id:
+            filters['tenant_id'] = self.tenant_id
+        if 'nova' in self.clients:
+            for server in self.clients['nova']().servers.list(search_opts=self._search('server')):
+                if self._in_tenant('server', server):
+                    self.add('server', server.id)
+        if 'cinder' in self.clients:
+            for volume in self.clients['cinder']().volumes.list(search_opts=self._search('volume')):
+                if self._in_tenant('volume', volume):
+                    self.add('volume', volume.id)
+        if 'neutron' in self.clients:
+            neutron = self.clients['neutron']()
+            for p in neutron.list_ports(device_owner='network:router_interface', **filters).get('ports'):
+                self.add('interface', p.get('id'), router_id=p.get('device_id'))
+            for r in neutron.list_routers(**filters).get('routers'):
+                self.add('router', r.get('id'))
+            for sn in neutron.list_subnets(**filters).get('subnets'):
+                self.add('subnet', sn.get('id'))
+            for n in neutron.list_networks(**filters).get('networks'):
+                if not n.get('router:external'):
+                    self.add('network', n.get('id'))
+        return self
+    
+    def _search(self, kind):
+        """Return the search_opts that list kind's resources in the tenant"""
+        if not self.all_tenants:
+            return None
+        return {'all_tenants': 1, self.OWNERS[kind][0]: self.tenant_id}
+    
+    def _in_tenant(self, kind, resource):
+        # Whether the tenant filter was applied or not, only the tenant's own resources are deleted
+        return not self.all_tenants or getattr(resource, self.OWNERS[kind][1], None) == self.tenant_id
+    
+    def _delete_server(self, resource_id):
+        return Call('nova', 'servers.delete', resource_id)
+    
+    def _delete_volume(self, resource_id):
+        return Call('cinder', 'volumes.delete', resource_id)
+    
+    def _delete_interface(self, resource_id):
+        router_id = self.resources['interface'][resource_id]['router_id']
+        return Call('neutron', 'remove_interface_router', router_id, {'port_id': resource_id})
+    
+    def _delete_router(self, resource_id):
+        return Call('neutron', 'delete_router', resource_id)
+    
+    def _delete_subnet(self, resource_id):
+        return Call('neutron', 'delete_subnet', resource_id)
+    
+    def _delete_network(self, resource_id):
+        return Call('neutron', 'delete_network', resource_id)
+    
+    def _delete(self, kind, resource_id):
+        try:
+            yield getattr(self, '_delete_%s'% kind)(resource_id)
+        except Exception as e:
+            if not _is_not_found(e):
+                raise Return((kind, resource_id, str(e) or e.__class__.__name__))
+    
+    def _status(self, kind, resource_id, status):
+        service, lister = self.LISTERS[kind]
+        status = yield Watch(service, lister, resource_id, status, failures=(), search_opts=self._search(kind))
+        raise Return(status)
+    
+    def _wait_for(self, loop, kind, ids, status):
+        """Wait for ids to reach status and return {id: status}"""
+        statuses = yield [loop.spawn(self._status(kind, i, status)) for i in ids]
+        raise Return(dict(zip(ids, statuses)))
+    
+    def _remaining(self, loop, kind, ids):
+        """Return which of ids still exist"""
+        if not ids:
+            raise Return([])
+        if kind in self.LISTERS:
+            statuses = yield loop.spawn(self._wait_for(loop, kind, ids, GONE))
+            raise Return([i for i in ids if statuses[i] != GONE])
+        plural = 'ports' if kind == 'interface' else kind + 's'
+        found = yield Call('neutron', 'list_%s'% plural, id=ids)
+        raise Return([r.get('id') for r in found.get(plural)])
+    
+    def run(self):
+        """Delete every scheduled resource, one tier at a time"""
+        loop = EventLoop(dict((service, teardown_concurrency) for service in self.clients), clients=self.clients)
+        loop.run(self._run(loop))
+        return self
+    
+    def _run(self, loop):
+        for tier in self.tiers():
+            yield loop.spawn(self._run_tier(loop, tier))
+    
+    def _run_tier(self, loop, tier):
+        """Delete one tier of resources and confirm they are gone"""
+        jobs = [(kind, i) for kind in tier for i in self.resources[kind]]
+        if not jobs:
+            return
+        start = time.time()
+        volumes = self.resources['volume'].keys()
+        if 'volume' in tier and volumes:
+            # Volumes can only be deleted once they are done creating or detaching
+            statuses = yield loop.spawn(self._wait_for(loop, 'volume', volumes, ('available', 'error', GONE)))
+            jobs = [j for j in jobs if j[0] != 'volume' or statuses[j[1]] != GONE]
+        failed = yield [loop.spawn(self._delete(kind, i)) for kind, i in jobs]
+        failed = [f for f in failed if f]
+        self.leaks.extend(failed)
+        failed = set(f[:2] for f in failed)
+        ids = dict((kind, [i for i in self.resources[kind] if (kind, i) not in failed]) for kind in tier)
+        remaining = yield [loop.spawn(self._remaining(loop, kind, ids[kind])) for kind in tier]
+        for kind, left in zip(tier, remaining):
+            for i in left:
+                self.leaks.append((kind, i, 'still present after delete'))
+            for i in set(ids[kind]) - set(left):
+                self.manifest.forget(kind, i)
+        elapsed = time.time() - start
+        self.timings.append((tier, len(jobs), elapsed))
+        totals = teardown_totals.setdefault(', '.join(tier), [0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += len(jobs)
+        totals[2] += elapsed
+    
+    def check(self):
+        """Raise TeapotException if anything was leaked"""
+        if self.leaks:
+            raise TeapotException("Leaked resources: %s"% ', '.join("%s %s (%s)"% l for l in self.leaks))
+
+def teardown_report(totals=None):
+    """Summarize the time spent in each teardown tier"""
+    lines = []
+    for tier, (teardowns, resources, seconds) in sorted((totals or teardown_totals).items()):
+        lines.append("Teardown %s: %d resources in %.1fs over %d teardowns"% (tier, resources, seconds, teardowns))
+    return '\n'.join(lines)
+
+class BootPipeline(object):
+    """Boot servers concurrently and time each one from request to ACTIVE
+    
+    Every server's latency is split into the API accepting the request,
+    scheduling (until nova's task state moves past 'scheduling') and
+    spawning (until the server is ACTIVE).  Scheduling can only be told
+    apart from spawning if nova exposes the OS-EXT-STS extension.  The
+    servers are created and watched on an EventLoop; nova is a function
+    that builds a client, so that every worker thread has its own.  A
+    request nova turns down is recorded in rejected and doesn't stop the
+    others.
+    """
+    def __init__(self, nova, concurrency=None, multi_create=None, teardown=None):
+        self.nova = nova
+        self.teardown = teardown
+        self.concurrency = concurrency or boot_concurrency
+        self.multi_create = boot_multi_create if multi_create is None else multi_create
+        self.requests = []
+        self.records = {}
+        self.rejected = []
+    
+    def add(self, name, image, flavor, count=1, **kwargs):
+        """Queue count servers named name to be booted"""
+        kwargs.setdefault('meta', run_tags())
+        if self.multi_create or count == 1:
+            self.requests.append((name, image, flavor, count, kwargs))
+        else:
+            for n in range(count):
+                self.requests.append(('%s_%03d'% (name, n + 1), image, flavor, 1, kwargs))
+    
+    def _boot(self, loop, request):
+        name, image, flavor, count, kwargs = request
+        try:
+            servers, requested, accepted = yield loop.spawn(self._create(request))
+        except Exception as e:
+            self.rejected.append((name, count, '%s: %s'% (e.__class__.__name__, e)))
+            return
+        for s in servers:
+            if self.teardown is not None:
+                self.teardown.add('server', s.id)
+            self.records[s.id] = {'name': getattr(s, 'name', name), 'requested': requested, 'accepted': accepted,
+                                  'scheduled': None, 'active': None, 'status': None}
+        yield [loop.spawn(self._wait(s.id)) for s in servers]
+    
+    def _create(self, request):
+        name, image, flavor, count, kwargs = request
+        if count > 1:
+            # nova only returns the first server, so the rest are found by name,
+            # leaving out any that already had it before this request
+            search = {'name': '^%s'% re.escape(name)}
+            existing = yield Call('nova', 'servers.list', search_opts=search)
+            before = set(s.id for s in existing)
+            requested = time.time()
+            yield Call('nova', 'servers.create', name=name, image=image, flavor=flavor,
+                       min_count=count, max_count=count, **kwargs)
+            accepted = time.time()
+            servers = yield Call('nova', 'servers.list', search_opts=search)
+            servers = [s for s in servers if s.id not in before and s.id not in self.records]
+        else:
+            requested = time.time()
+            server = yield Call('nova', 'servers.create', name=name, image=image, flavor=flavor, **kwargs)
+            servers = [server]
+            accepted = time.time()
+        raise Return((servers, requested, accepted))
+    
+    def _wait(self, server_id):
+        status = yield Watch('nova', 'servers.list', server_id, 'active', observe=self._observe)
+        self.records[server_id]['status'] = status
+    
+    def _observe(self, server, now):
+        record = self.records[server.id]
+        status = str(server.status).lower()
+        # Without the OS-EXT-STS extension there is no telling when scheduling finished
+        if hasattr(server, 'OS-EXT-STS:task_state') and record['scheduled'] is None:
+            if status != 'build' or getattr(server, 'OS-EXT-STS:task_state') not in (None, 'scheduling'):
+                record['scheduled'] = now
+        if status == 'active' and record['active'] is None:
+            record['active'] = now
+    
+    def run(self):
+        """Create every queued server and wait for them all to go ACTIVE or ERROR"""
+        loop = EventLoop({'nova': self.concurrency}, max_interval=1.0, clients={'nova': self.nova})
+        loop.run(self._run(loop))
+        return self
+    
+    def _run(self, loop):
+        yield [loop.spawn(self._boot(loop, request)) for request in self.requests]
+    
+    def failures(self):
+        """Return the names of servers that didn't go ACTIVE or couldn't be created"""
+        names = [r['name'] for r in self.records.values() if r['active'] is None]
+        for name, count, message in self.rejected:
+            names.extend([name] * count)
+        return sorted(names)
+    
+    def error_summary(self):
+        """Describe why each rejected request was turned down"""
+        return ', '.join('%s x%d (%s)'% r for r in self.rejected)
+    
+    def phases(self):
+        """Return {phase: [latencies]} for the servers that went ACTIVE"""
+        phases = {'api': [], 'scheduling': [], 'spawn': [], 'total': []}
+        for r in self.records.values():
+            if r['active'] is None:
+                continue
+            phases['api'].append(r['accepted'] - r['requested'])
+            phases['total'].append(r['active'] - r['requested'])
+            if r['scheduled'] is not None:
+                phases['scheduling'].append(r['scheduled'] - r['accepted'])
+                phases['spawn'].append(r['active'] - r['scheduled'])
+        return phases
+    
+    def report(self):
+        phases = self.phases()
+        failed = len(self.failures())
+        total = len(self.records) + sum(count for name, count, message in self.rejected)
+        lines = ["Boot: %d servers, %d failed (%.0f%%)"% (total, failed, 100.0 * failed / max(1, total))]
+        for phase in ('api', 'scheduling', 'spawn', 'total'):
+            if phase in ('scheduling', 'spawn') and phases['total'] and not phases[phase]:
+                lines.append("  %-10s unavailable, nova doesn't expose OS-EXT-STS task states"% phase)
+            else:
+                lines.append("  %-10s %s"% (phase, latency_summary(phases[phase])))
+        if self.rejected:
+            lines.append("  rejected: %s"% self.error_summary())
+        return '\n'.join(lines)
+
+class TopologyBuilder(object):
+    """Build the networks, subnets and routers described by a topology spec
+    
+    A spec is a dict with a list of 'networks', each with a 'name' and
+    optionally a 'subnet' name, an 'octet' for its /24 and a number of
+    'instances', and a list of 'routers', each with a 'name' and the names
+    of the 'networks' to attach.  Networks and subnets are created with one
+    bulk call each and router interfaces are attached concurrently on an
+    EventLoop.  neutron is a function that builds a client, so that every
+    worker thread has its own.
+    """
+    def __init__(self, neutron, spec, teardown=None):
+        self.neutron = neutron
+        self.spec = spec
+        self.teardown = teardown
+        self.networks = {}
+        self.subnets = {}
+        self.routers = {}
+    
+    def _octets(self):
+        networks = self.spec.get('networks', [])
+        used = set(n['octet'] for n in networks if 'octet' in n)
+        free = (o for o in range(1, 255) if o not in used)
+        octets = []
+        for n in networks:
+            octet = n.get('octet')
+            if octet is None:
+                octet = next(free, None)
+                if octet is None:
+                    raise TeapotException("Topology has more networks than fit in %s.0.0/16"% subnet_prefix)
+            octets.append(octet)
+        return octets
+    
+    def build(self):
+        """Create everything in the spec and return self"""
+        loop = EventLoop({'neutron': topology_concurrency}, clients={'neutron': self.neutron})
+        loop.run(self._build(loop))
+        return self
+    
+    def _build(self, loop):
+        networks = self.spec.get('networks', [])
+        if networks:
+            body = [{'name': n['name'], 'admin_state_up': True} for n in networks]
+            created = yield Call('neutron', 'create_network', {'networks': body})
+            for n, c in zip(networks, created.get('networks')):
+                self.networks[n['name']] = c.get('id')
+                self._track('network', c.get('id'))
+            body = []
+            for n, octet in zip(networks, self._octets()):
+                cidr, gateway = subnet_range(octet)
+                body.append({'name': n.get('subnet', '%s_subnet'% n['name']),
+                             'network_id': self.networks[n['name']],
+                             'cidr': cidr, 'ip_version': 4, 'gateway_ip': gateway})
+            created = yield Call('neutron', 'create_subnet', {'subnets': body})
+            for n, c in zip(networks, created.get('subnets')):
+                self.subnets[n['name']] = c.get('id')
+                self._track('subnet', c.get('id'))
+        interfaces = []
+        for router in self.spec.get('routers', []):
+            r = yield Call('neutron', 'create_router', {'router': {'name': router['name']}})
+            self.routers[router['name']] = r.get('router', {}).get('id', None)
+            self._track('router', self.routers[router['name']])
+            for name in router.get('networks', []):
+                if name not in self.subnets:
+                    raise TeapotException("Router %s refers to unknown network %s"% (router['name'], name))
+                interfaces.append((self.routers[router['name']], self.subnets[name]))
+        yield [loop.spawn(self._attach(interface)) for interface in interfaces]
+    
+    def _attach(self, interface):
+        router_id, subnet_id = interface
+        port = yield Call('neutron', 'add_interface_router', router_id, {'subnet_id': subnet_id})
+        self._track('interface', port.get('port_id'), router_id=router_id)
+    
+    def _track(self, kind, resource_id, **detail):
+        if self.teardown is not None:
+            self.teardown.add(kind, resource_id, **detail)
+    
+    def instances(self):
+        """Return (network name, network id, count) for each network that wants instances"""
+        return [(n['name'], self.networks[n['name']], n['instances'])
+                for n in self.spec.get('networks', []) if n.get('instances')]
+
+def scale_topology(networks, per_router=10, prefix='scale'):
+    """Return a topology spec with networks networks, per_router of them to a router"""
+    spec = {'networks': [], 'routers': []}
+    for n in range(networks):
+        spec['networks'].append({'name': '%s_network%d'% (prefix, n + 1)})
+        if n % per_router == 0:
+            spec['routers'].append({'name': '%s_router%d'% (prefix, len(spec['routers']) + 1), 'networks': []})
+        spec['routers'][-1]['networks'].append('%s_network%d'% (prefix, n + 1))
+    return spec
+
+def load_topology(path):
+    """Read a topology spec from a JSON file"""
+    with open(path) as f:
+        spec = json.load(f)
+    for n in spec.get('networks', []):
+        if 'name' not in n:
+            raise TeapotException("Every network in %s needs a name"% path)
+    return spec
+
+# Share the test tenant for the whole 'run' or create one per test 'class'
+fixture_scope='run'
+
+class ReferenceResolver(object):
+    """Run-wide cache of image and flavor ids looked up by name
+    
+    Images are looked up with glance's server-side name filter instead of
+    listing the whole catalog, and every id is only resolved once per run.
+    """
+    def __init__(self):
+        self._images = {}
+        self._flavors = {}
+        self.lookups = 0
+        self.hits = 0
+    
+    def image(self, name, glance=None):
+        """Return the id of the image called name"""
+        if name in self._images:
+            self.hits += 1
+            return self._images[name]
+        if glance is None:
+            glance = instrument(glanceclient.Client(endpoint=credentials.url_for('image'),
+                                                    token=credentials.admin().auth_token), 'glance')
+        self.lookups += 1
+        for image in glance.images.list(filters={'name': name}, page_size=image_page_size):
+            if image.name == name:
+                self._images[name] = image.id
+                return image.id
+        raise TeapotException("Couldn't find image named %s.  Do you need to set glance_image?"% (name,))
+    
+    def flavor(self, nova, name=None):
+        """Return the id of the flavor called name, or of the second flavor listed if name is None"""
+        if name is None:
+            name = nova_flavor
+        if name in self._flavors:
+            self.hits += 1
+            return self._flavors[name]
+        self.lookups += 1
+        flavors = nova.flavors.list(detailed=False)
+        if name is None:
+            self._flavors[name] = flavors[1].id
+        else:
+            for f in flavors:
+                if f.name == name:
+                    self._flavors[name] = f.id
+                    break
+            else:
+                raise TeapotException("Couldn't find flavor named %s.  Do you need to set nova_flavor?"% (name,))
+        return self._flavors[name]
+    
+    def report(self):
+        return "References: %d lookups, %d served from the cache"% (self.lookups, self.hits)
+
+references = ReferenceResolver()
+
+def find_by_name(keystone, kind, name):
+    """Look up a keystone 'user' or 'tenant' with the admin API's name filter
+    
+    Unlike users.find() and tenants.find() this doesn't list the whole
+    directory.  Returns the user or tenant as a dict, or None.
+    """
+    try:
+        resp, body = keystone.get('/%ss?name=%s'% (kind, urllib.quote(name)))
+    except ksexceptions.NotFound:
+        return None
+    return body.get(kind)
+
+class IdentityBenchmark(object):
+    """Create and look up users across tenants concurrently to see how keystone scales
+    
+    Every user is looked up by name as soon as it is created, so the name
+    lookup latencies can be compared as the directory grows.
+    """
+    def __init__(self, keystone, users, tenants, concurrency):
+        self.keystone = keystone
+        self.users = users
+        self.tenants = tenants
+        self.concurrency = concurrency
+        self.prefix = 'teapot-bench-%s'% uuid.uuid4().hex[:8]
+        self.samples = {}
+        self.errors = {}
+        self.elapsed = {}
+        self._created = 0
+        self._lock = threading.Lock()
+        self._tenant_ids = []
+        self._user_ids = []
+    
+    def _timed(self, phase, func, *args):
+        start = time.time()
+        try:
+            result = func(*args)
+        except Exception:
+            with self._lock:
+                self.errors[phase] = self.errors.get(phase, 0) + 1
+            return None
+        with self._lock:
+            self.samples.setdefault(phase, []).append((time.time() - start, self._created))
+        return result
+    
+    def _create_tenant(self, n):
+        t = self._timed('create tenant', self.keystone.tenants.create, '%s-t%d'% (self.prefix, n),
+                        "teapot run %s"% run_id)
+        if t is not None:
+            manifest.record('tenant', t.id)
+            self._tenant_ids.append(t.id)
+    
+    def _create_user(self, n):
+        name = '%s-u%d'% (self.prefix, n)
+        tenant_id = self._tenant_ids[n % len(self._tenant_ids)]
+        u = self._timed('create user', self.keystone.users.create, name, str(uuid.uuid4()),
+                        "%s@redhat.com"% name, tenant_id)
+        if u is None:
+            return
+        manifest.record('user', u.id)
+        with self._lock:
+            self._user_ids.append(u.id)
+            self._created += 1
+        self._timed('find user by name', find_by_name, self.keystone, 'user', name)
+    
+    def _delete(self, kind, resource_id):
+        manager = getattr(self.keystone, '%ss'% kind)
+        def delete():
+            manager.delete(resource_id)
+            manifest.forget(kind, resource_id)
+        self._timed('delete %s'% kind, delete)
+    
+    def _phase(self, pool, name, func, items):
+        start = time.time()
+        pool.map(func, items, 1)
+        self.elapsed[name] = time.time() - start
+    
+    def run(self):
+        pool = multiprocessing.pool.ThreadPool(self.concurrency)
+        try:
+            self._phase(pool, 'create tenant', self._create_tenant, range(self.tenants))
+            if not self._tenant_ids:
+                raise TeapotException("Couldn't create any tenants")
+            self._phase(pool, 'create user', self._create_user, range(self.users))
+            self.elapsed['find user by name'] = self.elapsed['create user']
+            self._phase(pool, 'get user by id',
+                        lambda i: self._timed('get user by id', self.keystone.users.get, i), self._user_ids)
+        finally:
+            self._phase(pool, 'delete user', lambda i: self._delete('user', i), self._user_ids)
+            self._phase(pool, 'delete tenant', lambda i: self._delete('tenant', i), self._tenant_ids)
+            pool.close()
+            pool.join()
+        return self
+    
+    def report(self):
+        lines = ["Identity benchmark: %d users across %d tenants with %d threads"% (self.users, self.tenants, self.concurrency)]
+        for phase in ('create tenant', 'create user', 'find user by name', 'get user by id', 'delete user', 'delete tenant'):
+            latencies = [l for l, size in self.samples.get(phase, [])]
+            lines.append("  %-18s %5d ok %4d errors %7.1f/s  %s"% (phase, len(latencies), self.errors.get(phase, 0),
+                                                                 len(latencies) / max(self.elapsed.get(phase, 0), 0.001),
+                                                                 latency_summary(latencies)))
+        lookups = sorted(self.samples.get('find user by name', []), key=lambda x: x[1])
+        if lookups:
+            lines.append("  Name lookups as the directory grows:")
+            step = max(1, len(lookups) // 10)
+            for n in range(0, len(lookups), step):
+                chunk = lookups[n:n + step]
+                lines.append("  %6d users  %s"% (chunk[-1][1], latency_summary([l for l, size in chunk])))
+        return '\n'.join(lines)
+
+class VolumeFanout(object):
+    """Create many volumes at once, wait for all of them and delete them again
+    
+    Every volume is a coroutine on an EventLoop, so the number in flight is
+    only bounded by cinder's worker pool.  cinder builds a new cinder client
+    and every worker thread gets its own.  Time to available runs from the
+    create call to the poll that saw the volume available, so its
+    resolution is the loop's poll interval.
+    """
+    def __init__(self, cinder, count, size, image=None, concurrency=None, teardown=None):
+        self.cinder = cinder
+        self.count = count
+        self.size = size
+        self.image = image
+        self.concurrency = min(concurrency or service_concurrency['cinder'], count)
+        self.teardown = teardown
+        self.latencies = {'create call': [], 'available': [], 'delete call': [], 'deleted': []}
+        self.errors = {}
+        # What went wrong in each phase, and how often
+        self.messages = {}
+        self.elapsed = {}
+        self.ids = []
+        self.polls = 0
+    
+    def _error(self, phase, detail):
+        self.errors[phase] = self.errors.get(phase, 0) + 1
+        if isinstance(detail, Exception):
+            detail = '%s: %s'% (detail.__class__.__name__, detail)
+        messages = self.messages.setdefault(phase, {})
+        messages[detail] = messages.get(detail, 0) + 1
+    
+    def error_summary(self):
+        """Describe every kind of error seen in each phase"""
+        return '; '.join('%s: %s'% (phase, ', '.join('%s (x%d)'% m for m in sorted(messages.items())))
+                         for phase, messages in sorted(self.messages.items()))
+    
+    def _create(self, n):
+        kw = {'display_name': 'teapot fanout %d'% n, 'size': self.size, 'metadata': run_tags()}
+        if self.image is not None:
+            kw['imageRef'] = self.image
+        start = time.time()
+        try:
+            volume = yield Call('cinder', 'volumes.create', **kw)
+        except Exception as e:
+            self._error('create call', e)
+            return
+        self.latencies['create call'].append(time.time() - start)
+        self.ids.append(volume.id)
+        if self.teardown is not None:
+            self.teardown.add('volume', volume.id)
+        status = yield Watch('cinder', 'volumes.list', volume.id, 'available')
+        if status == 'available':
+            self.latencies['available'].append(time.time() - start)
+        else:
+            self._error('available', 'status %s'% status)
+        raise Return((volume.id, status))
+    
+    def _delete(self, volume_id):
+        start = time.time()
+        try:
+            yield Call('cinder', 'volumes.delete', volume_id)
+        except Exception as e:
+            self._error('delete call', e)
+            return
+        self.latencies['delete call'].append(time.time() - start)
+        status = yield Watch('cinder', 'volumes.list', volume_id, GONE)
+        if status == GONE:
+            self.latencies['deleted'].append(time.time() - start)
+        else:
+            self._error('deleted', 'status %s'% status)
+    
+    def _run(self, loop):
+        start = time.time()
+        created = yield [loop.spawn(self._create(n)) for n in range(self.count)]
+        self.elapsed['available'] = time.time() - start
+        start = time.time()
+        yield [loop.spawn(self._delete(c[0])) for c in created if c and c[1] in ('available', 'error')]
+        self.elapsed['deleted'] = time.time() - start
+    
+    def run(self):
+        loop = EventLoop({'cinder': self.concurrency}, clients={'cinder': self.cinder})
+        loop.run(self._run(loop))
+        self.polls = loop.polls
+        return self
+    
+    def report(self):
+        available = len(self.latencies['available'])
+        lines = ["Cinder fan-out: %d x %d GB %s volumes, %d calls in flight, %d status polls"%
+                 (self.count, self.size, 'from-image' if self.image else 'blank', self.concurrency, self.polls),
+                 "  %.1f GB/min provisioned"% (available * self.size * 60.0 / max(self.elapsed.get('available', 0), 0.001))]
+        for phase in ('create call', 'available', 'delete call', 'deleted'):
+            lines.append("  %-12s %4d ok %4d errors  %s"% (phase, len(self.latencies[phase]), self.errors.get(phase, 0),
+                                                          latency_summary(self.latencies[phase])))
+        if self.messages:
+            lines.append("  errors: %s"% self.error_summary())
+        return '\n'.join(lines)
+
+def peak_rss():
+    """Peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class GeneratedImage(object):
+    """File-like image body of size bytes that is generated as it is read
+    
+    Only one chunk is held in memory at a time and the md5 of everything
+    read so far is kept, so multi-GB images can be uploaded from anywhere.
+    """
+    def __init__(self, size, chunk_size=None):
+        self.size = size
+        self.chunk_size = chunk_size or image_chunk_size
+        self.offset = 0
+        self.md5 = hashlib.md5()
+        self._block = os.urandom(self.chunk_size)
+    
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.chunk_size
+        n = min(n, self.chunk_size, self.size - self.offset)
+        if n <= 0:
+            return ''
+        # Stamp each chunk with its offset so the image doesn't dedupe
+        stamp = '%016x'% self.offset
+        chunk = (stamp + self._block[len(stamp):])[:n]
+        self.offset += n
+        self.md5.update(chunk)
+        return chunk
+    
+    def checksum(self):
+        return self.md5.hexdigest()
+
+class ImageTransfers(object):
+    """Upload and download generated images concurrently and measure the throughput of each direction
+    
+    All of the uploads run before the downloads so each direction is timed
+    on its own.  Downloads are streamed and checked against the md5 of what
+    was uploaded.  glance is a factory; every transfer thread builds its own
+    client with it, since a glance client can't be used by two threads at once.
+    """
+    def __init__(self, glance, size, transfers=1):
+        self.new_glance = glance
+        self.size = size
+        self.transfers = transfers
+        self.images = []
+        self.elapsed = {}
+        self.latencies = {'upload': [], 'download': []}
+        self.rss = (peak_rss(), None)
+        self._checksums = {}
+        self._local = threading.local()
+    
+    @property
+    def glance(self):
+        """This thread's own glance client"""
+        if getattr(self._local, 'glance', None) is None:
+            self._local.glance = self.new_glance()
+        return self._local.glance
+    
+    def _upload(self, n):
+        data = GeneratedImage(self.size)
+        start = time.time()
+        image = self.glance.images.create(name='teapot transfer %d'% n, disk_format='raw',
+                                          container_format='bare', size=self.size, data=data,
+                                          properties=run_tags())
+        manifest.record('image', image.id)
+        self.latencies['upload'].append(time.time() - start)
+        self.images.append(image.id)
+        self._checksums[image.id] = data.checksum()
+        return image.id
+    
+    def _download(self, image_id):
+        start = time.time()
+        md5 = hashlib.md5()
+        received = 0
+        for chunk in self.glance.images.data(image_id):
+            md5.update(chunk)
+            received += len(chunk)
+        self.latencies['download'].append(time.time() - start)
+        if received != self.size or md5.hexdigest() != self._checksums[image_id]:
+            raise TeapotException("Image %s came back with %d bytes and md5 %s, expected %d bytes and md5 %s"%
+                                  (image_id, received, md5.hexdigest(), self.size, self._checksums[image_id]))
+    
+    def run(self):
+        pool = multiprocessing.pool.ThreadPool(self.transfers)
+        try:
+            start = time.time()
+            ids = pool.map(self._upload, range(self.transfers), 1)
+            self.elapsed['upload'] = time.time() - start
+            start = time.time()
+            pool.map(self._download, ids, 1)
+            self.elapsed['download'] = time.time() - start
+        finally:
+            pool.close()
+            pool.join()
+            self.rss = (self.rss[0], peak_rss())
+        return self
+    
+    def report(self):
+        total = self.size * self.transfers / 1048576.0
+        lines = ["Glance transfers: %d x %.1f MB images, peak RSS %.1f MB (%.1f MB before)"%
+                 (self.transfers, self.size / 1048576.0, self.rss[1] or self.rss[0], self.rss[0])]
+        for direction in ('upload', 'download'):
+            if direction in self.elapsed:
+                lines.append("  %-8s %8.1f MB/s  %s"% (direction, total / max(self.elapsed[direction], 0.001),
+                                                      latency_summary(self.latencies[direction])))
+        return '\n'.join(lines)
+
+class TenantFixture(object):
+    """Test tenant, user, keypair and clients shared between tests
+    
+    The fixture is created the first time a test class acquires it and
+    deleted by release(), at the end of the run or of the class depending
+    on fixture_scope.  Tests only clean up the resources they created.
+    """
+    shared = None
+    # Whether the tenant and what the tests create in it are kept in the run manifest
+    tracked = True
+    
+    def __init__(self, tenant_name=None, user_name=None, state=None):
+        """Create the tenant and user, or look up the ones recorded in state"""
+        self.keystone = credentials.admin()
+        self.manifest = manifest
+        self.tenant_name = tenant_name or test_tenant
+        self.user_name = user_name or test_user
+        if state is None:
+            self._tear_down_existing()
+            self.t = self.keystone.tenants.create(self.tenant_name, "teapot run %s"% run_id)
+            if self.tracked:
+                self.manifest.record('tenant', self.t.id, name=self.tenant_name)
+            self.password = str(uuid.uuid4())[:8]
+            self.u = self.keystone.users.create(self.user_name, self.password, "%s@redhat.com"% self.user_name, self.t.id)
+            if self.tracked:
+                # Enough to log back in as the user and clean up if the run crashes
+                self.manifest.record('user', self.u.id, tenant_id=self.t.id, name=self.user_name,
+                                     tenant_name=self.tenant_name, password=self.password)
+        else:
+            self.t = self.keystone.tenants.get(state['tenant_id'])
+            self.u = self.keystone.users.get(state['user_id'])
+            self.password = state['password']
+        self._clients = {}
+    
+    def _tear_down_existing(self):
+        """Delete a user and tenant of the same names left over by an interrupted run"""
+        u = find_by_name(self.keystone, 'user', self.user_name)
+        if u is not None:
+            self.keystone.users.delete(u['id'])
+        t = find_by_name(self.keystone, 'tenant', self.tenant_name)
+        if t is not None:
+            self.keystone.tenants.delete(t['id'])
+    
+    @classmethod
+    def acquire(cls):
+        if cls.shared is None:
+            cls.shared = cls()
+        return cls.shared
+    
+    @classmethod
+    def release(cls):
+        """Delete the shared fixture and anything left behind in its tenant"""
+        fixture, cls.shared = cls.shared, None
+        if fixture is not None:
+            fixture.destroy()
+    
+    def testuser(self):
+        return credentials.client(self.user_name, self.password, self.tenant_name)
+    
+    def _client(self, service, factory, token=None):
+        # Token based clients are rebuilt whenever the cached token is refreshed
+        if service not in self._clients or self._clients[service][0] != token:
+            self._clients[service] = (token, instrument(factory(), service))
+        return self._clients[service][1]
+    
+    def neutron(self):
+        token = self.testuser().auth_token
+        endpoint = credentials.url_for('network')
+        return self._client('neutron', lambda: neutronclient.Client(endpoint_url=endpoint, token=token), token)
+    
+    def glance(self):
+        token = self.testuser().auth_token
+        endpoint = credentials.url_for('image')
+        return self._client('glance', lambda: glanceclient.Client(endpoint=endpoint, token=token), token)
+    
+    def cinder(self):
+        token = self.testuser().auth_token
+        return self._client('cinder', lambda: token_client(cinderclient.Client, 'volume', self.user_name,
+                                                           self.password, self.tenant_name), token)
+    
+    def new_cinder(self):
+        """Build a cinder client for the test user that isn't shared, e.g. for a worker thread"""
+        return instrument(token_client(cinderclient.Client, 'volume', self.user_name,
+                                       self.password, self.tenant_name), 'cinder')
+    
+    def new_nova(self):
+        """Build a nova client for the test user that isn't shared"""
+        return instrument(token_client(novaclient.Client, 'compute', self.user_name,
+                                       self.password, self.tenant_name), 'nova')
+    
+    def new_neutron(self):
+        """Build a neutron client for the test user that isn't shared"""
+        return instrument(neutronclient.Client(endpoint_url=credentials.url_for('network'),
+                                               token=self.testuser().auth_token), 'neutron')
+    
+    def volume_quota(self, volumes, gigabytes):
+        """Make sure the tenant may have this many volumes and gigabytes"""
+        admin = instrument(token_client(cinderclient.Client, 'volume', admin_user, admin_pass, admin_tenant), 'cinder')
+        admin.quotas.update(self.t.id, volumes=volumes, gigabytes=gigabytes)
+    
+    def nova(self, keypair=True):
+        first = keypair and 'nova' not in self._clients
+        token = self.testuser().auth_token
+        nova = self._client('nova', lambda: token_client(novaclient.Client, 'compute', self.user_name,
+                                                         self.password, self.tenant_name), token)
+        if first:
+            with open(os.path.expanduser('~/.ssh/id_rsa.pub')) as fpubkey:
+                try:
+                    nova.keypairs.create(name="mykey", public_key=fpubkey.read())
+                except Exception as e:
+                    # A reattached tenant already has its keypair
+                    if getattr(e, 'code', None) != 409:
+                        raise
+        return nova
+    
+    def destroy(self):
+        teardown = TenantTeardown(tenant_id=self.t.id)
+        teardown.manifest = self.manifest
+        factories = {'nova': self.new_nova, 'cinder': self.new_cinder, 'neutron': self.new_neutron}
+        for service in factories:
+            if service in self._clients:
+                teardown.clients[service] = factories[service]
+        if self.tracked:
+            # Only what the run created in the tenant and hasn't deleted yet
+            teardown.restore(self.manifest.outstanding(tenant_id=self.t.id))
+        else:
+            teardown.discover()
+        teardown.run()
+        if 'nova' in self._clients:
+            try:
+                self.nova().keypairs.delete('mykey')
+            except Exception as e:
+                if not _is_not_found(e):
+                    raise
+        self.keystone.users.delete(self.u)
+        self.keystone.tenants.delete(self.t)
+        if self.tracked:
+            self.manifest.forget('user', self.u.id)
+            self.manifest.forget('tenant', self.t.id)
+        credentials.forget(self.user_name, self.tenant_name)
+        teardown.check()
+
+class FixtureTestCase(unittest.TestCase):
+    """Base class for tests that run in the shared test tenant"""
+    @classmethod
+    def setUpClass(cls):
+        cls.fixture = TenantFixture.acquire()
+    
+    @classmethod
+    def tearDownClass(cls):
+        if fixture_scope == 'class':
+            TenantFixture.release()
+    
+    def setUp(self):
+        self.keystone = self.fixture.keystone
+        self.t = self.fixture.t
+        self.u = self.fixture.u
+        self.password = self.fixture.password
+        self.keystone_testuser = self.fixture.testuser()
+        self.created = TenantTeardown(tenant_id=self.t.id)
+    
+    def tearDown(self):
+        self.created.run().check()
+
+class ManualEnvironment(TenantFixture):
+    """A tenant with multivm_topology built and booted in it for manual testing
+    
+    Everything needed to find the environment again is returned by state(),
+    so it can be saved by an EnvironmentPool and picked up by a later run.
+    An environment is only marked built once build() has finished, and
+    owner is the session using it.
+    """
+    # Environments outlive the run, so they are kept in the pool's state file instead
+    tracked = False
+    
+    def __init__(self, name, state=None):
+        super(ManualEnvironment, self).__init__(name, name, state)
+        self.name = name
+        state = state or {}
+        self.networks = state.get('networks', {})
+        self.subnets = state.get('subnets', {})
+        self.routers = state.get('routers', {})
+        self.interfaces = state.get('interfaces', 0)
+        self.servers = state.get('servers', {})
+        self.in_use = state.get('in_use', False)
+        self.owner = state.get('owner')
+        self.built_at = state.get('built_at', time.time())
+        # Environments saved before builds were marked are checked against multivm_topology instead
+        self.built = state.get('built', bool(state))
+    
+    def state(self):
+        return {'name': self.name, 'tenant_id': self.t.id, 'user_id': self.u.id, 'password': self.password,
+                'networks': self.networks, 'subnets': self.subnets, 'routers': self.routers,
+                'interfaces': self.interfaces, 'servers': self.servers, 'in_use': self.in_use,
+                'owner': self.owner, 'built_at': self.built_at, 'built': self.built}
+    
+    def build(self):
+        """Build the topology and boot its servers"""
+        self.built = False
+        topology = TopologyBuilder(self.new_neutron, multivm_topology).build()
+        self.networks, self.subnets, self.routers = topology.networks, topology.subnets, topology.routers
+        self.interfaces = sum(len(r.get('networks', [])) for r in multivm_topology.get('routers', []))
+        self.servers = {}
+        self._boot(dict((name, count) for name, netid, count in topology.instances()))
+        self.built = True
+        return self
+    
+    def _boot(self, wanted):
+        """Boot wanted {network name: count} more servers"""
+        nova = self.nova()
+        f = references.flavor(nova)
+        i = references.image(glance_image)
+        pipeline = BootPipeline(self.new_nova, multi_create=False)
+        for name, count in sorted(wanted.items()):
+            base = '%s_server_%s'% (name, uuid.uuid4().hex[:6])
+            pipeline.add(base, i, f, count=count, key_name='mykey', nics=[{'net-id': self.networks[name]}])
+        pipeline.run()
+        for server_id, record in pipeline.records.items():
+            self.servers[server_id] = record['name'].rsplit('_server_', 1)[0]
+        if pipeline.rejected:
+            raise TeapotException("Couldn't boot servers: %s"% pipeline.error_summary())
+    
+    def check(self):
+        """Return a list of what is missing or broken, empty if the environment is healthy"""
+        if not self.built:
+            return ['unfinished build']
+        problems = []
+        networks = multivm_topology.get('networks', [])
+        if (len(self.networks) < len(networks) or
+                len(self.servers) < sum(n.get('instances', 0) for n in networks)):
+            problems.append('topology smaller than multivm_topology')
+        neutron = self.neutron()
+        for kind, ids in (('network', self.networks), ('subnet', self.subnets), ('router', self.routers)):
+            lister = getattr(neutron, 'list_%ss'% kind)
+            found = set(x.get('id') for x in lister(tenant_id=self.t.id).get('%ss'% kind))
+            problems.extend('%s %s'% (kind, name) for name, i in sorted(ids.items()) if i not in found)
+        ports = neutron.list_ports(device_owner='network:router_interface', tenant_id=self.t.id).get('ports')
+        if len(ports) < self.interfaces:
+            problems.append('%d router interfaces'% (self.interfaces - len(ports),))
+        statuses = dict((s.id, str(s.status).lower()) for s in self.nova().servers.list())
+        for server_id in sorted(self.servers):
+            if statuses.get(server_id) != 'active':
+                problems.append('server %s (%s)'% (server_id, statuses.get(server_id, GONE)))
+        return problems
+    
+    def repair(self, problems):
+        """Fix what check() found, rebuilding as little as possible
+        
+        Broken servers are deleted and booted again.  Anything missing from
+        the network topology means it is torn down and built again.
+        """
+        if [p for p in problems if not p.startswith('server ')]:
+            teardown = TenantTeardown(self.new_neutron, self.new_nova, None, self.t.id)
+            teardown.discover().run().check()
+            return self.build()
+        statuses = dict((s.id, str(s.status).lower()) for s in self.nova().servers.list())
+        broken = [i for i in self.servers if statuses.get(i) != 'active']
+        teardown = TenantTeardown(nova=self.new_nova, tenant_id=self.t.id)
+        wanted = {}
+        for server_id in broken:
+            if server_id in statuses:
+                teardown.add('server', server_id)
+            network = self.servers.pop(server_id)
+            wanted[network] = wanted.get(network, 0) + 1
+        teardown.run().check()
+        self._boot(wanted)
+        return self
+
+def session_owner():
+    """Identify this session as the owner of an environment"""
+    return {'host': os.uname()[1], 'pid': os.getpid()}
+
+def owner_alive(owner):
+    """Whether the session that owns an environment may still be running"""
+    if not owner:
+        return False
+    if owner.get('host') != os.uname()[1]:
+        # No way to tell from here, so leave it to its owner
+        return True
+    try:
+        os.kill(owner['pid'], 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class EnvironmentPool(object):
+    """Manual mode environments saved in env_state_file
+    
+    acquire() reattaches to an environment whose session died, or takes a
+    healthy idle one, and only builds from scratch when there is nothing to
+    reuse.  Environments are repaired before they are handed out.  Changes
+    to the state file are made under a lock file, so concurrent sessions
+    never claim the same environment.
+    """
+    def __init__(self, path=None):
+        self.path = path or env_state_file
+        self.states = []
+        self._load()
+    
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.states = json.load(f).get('environments', [])
+    
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the pool's lock file, with the states freshly read from the state file"""
+        fd = os.open('%s.lock'% self.path, os.O_WRONLY | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self._load()
+            yield
+        finally:
+            os.close(fd)
+    
+    def save(self):
+        tmp = '%s.tmp'% self.path
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'environments': self.states}, f, indent=2)
+        os.rename(tmp, self.path)
+    
+    def _put(self, env):
+        with self._locked():
+            self.states = [s for s in self.states if s['name'] != env.name] + [env.state()]
+            self.save()
+    
+    def _drop(self, name):
+        with self._locked():
+            self.states = [s for s in self.states if s['name'] != name]
+            self.save()
+    
+    def _claim(self):
+        """Mark the environment this session should use as ours and return how it was found and its state"""
+        with self._locked():
+            for how, in_use in (('reattached', True), ('recycled', False)):
+                for state in self.states:
+                    if state.get('in_use', False) == in_use and not (in_use and owner_alive(state.get('owner'))):
+                        state['in_use'] = True
+                        state['owner'] = session_owner()
+                        self.save()
+                        return how, state
+        return None, None
+    
+    def _attach(self, state):
+        """Return the healthy environment for state, or None if its tenant is gone"""
+        try:
+            env = ManualEnvironment(state['name'], state)
+        except ksexceptions.NotFound:
+            self._drop(state['name'])
+            return None
+        problems = env.check()
+        if problems:
+            print "Repairing %s: %s"% (env.name, ', '.join(problems))
+            env.repair(problems)
+            self._put(env)
+        return env
+    
+    def build(self, in_use=False):
+        env = ManualEnvironment('teapot-env-%s'% uuid.uuid4().hex[:6])
+        # Save it, claimed by this session, before building so nobody else picks
+        # it up half built and a failed build can still be found and cleaned up
+        env.in_use = True
+        env.owner = session_owner()
+        self._put(env)
+        try:
+            env.build()
+        finally:
+            env.in_use = in_use
+            if not in_use:
+                env.owner = None
+            self._put(env)
+        return env
+    
+    def acquire(self):
+        """Return (environment, how it was obtained) for a manual session"""
+        while True:
+            how, state = self._claim()
+            if state is None:
+                return self.build(in_use=True), 'built'
+            env = self._attach(state)
+            if env is not None:
+                return env, how
+    
+    def release(self, env):
+        """Return env to the pool of idle environments"""
+        env.in_use = False
+        env.owner = None
+        self._put(env)
+    
+    def prewarm(self, size):
+        """Build idle environments until there are size of them"""
+        with self._locked():
+            idle = len([s for s in self.states if not s.get('in_use')])
+        for n in range(size - idle):
+            env = self.build()
+            print "Built %s"% env.name
+    
+    def destroy(self):
+        """Tear down every environment in the pool that no live session is using"""
+        with self._locked():
+            states = list(self.states)
+        for state in states:
+            if state.get('in_use') and owner_alive(state.get('owner')) and state['owner'] != session_owner():
+                print "Skipping %s, in use by pid %s on %s"% (state['name'], state['owner']['pid'], state['owner']['host'])
+                continue
+            try:
+                env = ManualEnvironment(state['name'], state)
+            except ksexceptions.NotFound:
+                pass
+            else:
+                # Reattached environments have no clients yet, and destroy() only cleans up after the ones it has
+                env.neutron()
+                env.nova()
+                env.destroy()
+                print "Destroyed %s"% env.name
+            self._drop(state['name'])
+
+# The client each kind of resource in a tenant is deleted with
+sweep_services = {'server': 'nova', 'volume': 'cinder', 'interface': 'neutron',
+                  'router': 'neutron', 'subnet': 'neutron', 'network': 'neutron'}
+
+def _admin_clients():
+    """Functions that build the admin's clients for each service"""
+    admin = credentials.admin()
+    return {
+        'neutron': lambda: instrument(neutronclient.Client(endpoint_url=credentials.url_for('network'),
+                                                           token=admin.auth_token), 'neutron'),
+        'nova': lambda: instrument(token_client(novaclient.Client, 'compute', admin_user, admin_pass,
+                                                admin_tenant), 'nova'),
+        'cinder': lambda: instrument(token_client(cinderclient.Client, 'volume', admin_user, admin_pass,
+                                                  admin_tenant), 'cinder'),
+        'glance': lambda: instrument(glanceclient.Client(endpoint=credentials.url_for('image'),
+                                                         token=admin.auth_token), 'glance')}
+
+def find_tagged(leftover):
+    """Record the servers, volumes and images tagged with a run's id that its manifest is missing
+    
+    A run that crashed between a create and recording it leaves resources
+    that only their teapot_run tag ties to the run.  They are looked up as
+    the admin across all tenants and added to the manifest, with their
+    tenant, so sweep_run deletes them too.  Only the components being
+    tested (see -c) are searched.  Returns how many were added.
+    """
+    clients = _admin_clients()
+    run = leftover.run_id
+    tagged = lambda metadata: (metadata or {}).get('teapot_run') == run
+    found = []
+    if TEST_NOVA:
+        # nova's metadata filter varies between releases, so servers are matched here
+        for server in clients['nova']().servers.list(search_opts={'all_tenants': 1}):
+            if tagged(getattr(server, 'metadata', None)):
+                found.append(('server', server.id, getattr(server, 'tenant_id', None)))
+    if TEST_CINDER:
+        search = {'all_tenants': 1, 'metadata': {'teapot_run': run}}
+        for volume in clients['cinder']().volumes.list(search_opts=search):
+            if tagged(getattr(volume, 'metadata', None)):
+                found.append(('volume', volume.id, getattr(volume, 'os-vol-tenant-attr:tenant_id', None)))
+    if TEST_GLANCE:
+        filters = {'property-teapot_run': run}
+        for image in clients['glance']().images.list(filters=filters, page_size=image_page_size):
+            if tagged(getattr(image, 'properties', None)):
+                found.append(('image', image.id, None))
+    known = set((e['kind'], e['id']) for e in leftover.outstanding())
+    added = 0
+    for kind, resource_id, tenant_id in found:
+        if (kind, resource_id) not in known:
+            leftover.record(kind, resource_id, tenant_id=tenant_id)
+            added += 1
+    return added
+
+def sweep_run(leftover):
+    """Delete what a crashed run recorded in its manifest and return what couldn't be
+    
+    Resources in a test tenant are deleted as the tenant's user, together
+    with anything else a tenant-filtered listing finds there, and then the
+    tenant itself goes.  If the user can't log in any more they are deleted
+    as the admin instead, by id and by listings filtered to the tenant, and
+    so are resources in tenants the manifest has no user for.  Only the
+    clients the recorded resources need are built.  Images and
+    keystone-only tenants and users are deleted by id as the admin.
+    """
+    admin = credentials.admin()
+    admin_clients = _admin_clients()
+    # Tenants whose resources wouldn't all go are kept, with their user, to try again
+    kept = set()
+    users = [e for e in leftover.outstanding() if e['kind'] == 'user' and e.get('password')]
+    for entry in users:
+        entries = leftover.outstanding(tenant_id=entry['tenant_id'])
+        services = set(sweep_services[e['kind']] for e in entries if e['kind'] in sweep_services)
+        teardown = TenantTeardown(tenant_id=entry['tenant_id'])
+        teardown.manifest = leftover
+        try:
+            fixture = TenantFixture(entry['tenant_name'], entry['name'],
+                                    {'tenant_id': entry['tenant_id'], 'user_id': entry['id'], 'password': entry['password']})
+        except ksexceptions.NotFound:
+            fixture = None
+            teardown.all_tenants = True
+            for service in services:
+                teardown.clients[service] = admin_clients[service]
+            teardown.discover()
+        else:
+            fixture.manifest = leftover
+            clients = {'neutron': fixture.new_neutron, 'cinder': fixture.new_cinder, 'nova': fixture.new_nova}
+            for service in services:
+                teardown.clients[service] = clients[service]
+            teardown.discover()
+        teardown.restore(entries).run()
+        if teardown.leaks:
+            kept.add(entry['tenant_id'])
+        elif fixture is not None:
+            fixture.destroy()
+    # Resources found by their tag can be in tenants that have no user to log in as
+    orphans = {}
+    user_tenants = set(u['tenant_id'] for u in users)
+    for entry in leftover.outstanding():
+        if entry['kind'] in sweep_services and entry.get('tenant_id') not in user_tenants:
+            orphans.setdefault(entry.get('tenant_id'), []).append(entry)
+    for tenant_id, entries in orphans.items():
+        teardown = TenantTeardown(tenant_id=tenant_id)
+        teardown.manifest = leftover
+        teardown.all_tenants = True
+        for service in set(sweep_services[e['kind']] for e in entries):
+            teardown.clients[service] = admin_clients[service]
+        teardown.restore(entries).run()
+    glance = None
+    for entry in leftover.outstanding():
+        try:
+            if entry['kind'] == 'image':
+                if glance is None:
+                    glance = admin_clients['glance']()
+                glance.images.delete(entry['id'])
+            elif entry['kind'] in ('user', 'tenant'):
+                if (entry['id'] if entry['kind'] == 'tenant' else entry.get('tenant_id')) in kept:
+                    continue
+                getattr(admin, '%ss'% entry['kind']).delete(entry['id'])
+            else:
+                continue
+        except Exception as e:
+            if not _is_not_found(e):
+                continue
+        leftover.forget(entry['kind'], entry['id'])
+    return leftover.close()
+
+def sweep(directory=None):
+    """Clean up after every run that left a manifest behind"""
+    lines = []
+    for leftover in RunManifest.leftovers(directory):
+        idle = time.time() - os.path.getmtime(leftover.path)
+        if idle < sweep_min_age:
+            lines.append("Skipped run %s, its manifest was written %ds ago"% (leftover.run_id, idle))
+            continue
+        find_tagged(leftover)
+        found = len(leftover.outstanding())
+        left = sweep_run(leftover)
+        lines.append("Swept run %s: %d of %d resources deleted"% (leftover.run_id, found - len(left), found))
+        for entry in left:
+            lines.append("  left %s %s"% (entry['kind'], entry['id']))
+    return '\n'.join(lines) or "Nothing to sweep"
+
+def identity_report():
+    """Count the writes made to keystone, as recorded by the instrumented clients"""
+    writes = {}
+    for operation, samples in api_metrics.samples.items():
+        if operation.startswith('keystone.') and operation.rsplit('.', 1)[-1] in ('create', 'delete', 'update'):
+            writes[operation[len('keystone.'):]] = len(samples)
+    return "Identity: %d writes (%s)"% (sum(writes.values()), ', '.join("%s %d"% w for w in sorted(writes.items())))
+
 class TestKeystone(unittest.TestCase):
     """Set of Keystone-specific tests"""
     def setUp(self):
-        self.keystone = ksclient.Client(auth_url=keystone_url,
-                                        username=admin_user,
-                                        password=admin_pass,
-                                        tenant_name=admin_tenant)
+        self.keystone = credentials.admin()
+        # Kept apart from the shared test tenant so cleaning up can't remove it
+        self.tenant_name = '%s keystone'% test_tenant
+        self.user_name = '%s_keystone'% test_user
         self._tear_down_existing()
     
     def _tear_down_existing(self):
         """Try to delete any left over keystone artifacts"""
-        try:
-            u = self.keystone.users.find(name=test_user)
-            self.keystone.users.delete(u)
-        except:
-            # This raises an exception if it can't find the user
-            pass
-        try:
-            t = self.keystone.tenants.find(name=test_tenant)
-            self.keystone.tenants.delete(t)
-        except:
-            pass
+        u = find_by_name(self.keystone, 'user', self.user_name)
+        if u is not None:
+            self.keystone.users.delete(u['id'])
+        t = find_by_name(self.keystone, 'tenant', self.tenant_name)
+        if t is not None:
+            self.keystone.tenants.delete(t['id'])
 
     def test_001_service_catalog(self):
         """KEYSTONE: services we expect to exist have entries in the catalog."""
@@ -101,85 +2424,66 @@ class TestKeystone(unittest.TestCase):
         
     def test_002_account_creation(self):
         """KEYSTONE: we can create a tenant and a user associated with the tenant"""
-        t = self.keystone.tenants.create(test_tenant)
-        u = self.keystone.users.create(test_user, str(uuid.uuid4()), "%s@redhat.com"% test_user, t.id)
-        # This method loads the whole userlist.  Probably should skip this
-        # for large directories.
-        i = self.keystone.users.find(name=test_user)
+        t = self.keystone.tenants.create(self.tenant_name, "teapot run %s"% run_id)
+        manifest.record('tenant', t.id)
+        u = self.keystone.users.create(self.user_name, str(uuid.uuid4()), "%s@redhat.com"% self.user_name, t.id)
+        manifest.record('user', u.id)
+        i = self.keystone.users.get(u.id)
         self.assertTrue(i.id)
+        self.assertEqual(find_by_name(self.keystone, 'user', self.user_name)['id'], u.id)
         # Tear down the tenant.
         self.keystone.users.delete(u)
+        manifest.forget('user', u.id)
         self.keystone.tenants.delete(t)
+        manifest.forget('tenant', t.id)
 
 class TestGlance(unittest.TestCase):
     """Set of Glance-specific tests"""
     def setUp(self):
-        self.keystone = ksclient.Client(auth_url=keystone_url,
-                                        username=admin_user,
-                                        password=admin_pass,
-                                        tenant_name=admin_tenant)
-        self.endpoint = self.keystone.service_catalog.url_for(service_type='image',
-                                                              endpoint_type='publicURL')
-        self.glance = glanceclient.Client(endpoint=self.endpoint, token=self.keystone.auth_token)
+        self.keystone = credentials.admin()
+        self.endpoint = credentials.url_for('image')
+        self.glance = self.new_glance()
+        self.images = []
+    
+    def new_glance(self):
+        return instrument(glanceclient.Client(endpoint=self.endpoint, token=self.keystone.auth_token), 'glance')
     
     def test_001_create_image(self):
         """GLANCE: we can create an image"""
-        self.image = self.glance.images.create(name='unittest image')
-        self.assertTrue(self.image.id)
+        image = self.glance.images.create(name='unittest image', properties=run_tags())
+        manifest.record('image', image.id)
+        self.images.append(image.id)
+        self.assertTrue(image.id)
+    
+    def test_002_image_transfer_throughput(self):
+        """GLANCE: we can upload and download image data"""
+        if not image_transfer_size:
+            self.skipTest("image_transfer_size is 0")
+        transfers = ImageTransfers(self.new_glance, image_transfer_size * 1048576, image_transfers)
+        try:
+            transfers.run()
+        finally:
+            self.images.extend(transfers.images)
+        run_reports.append(transfers.report())
     
     def tearDown(self):
-        self.glance.images.delete(self.image)
+        for image_id in self.images:
+            self.glance.images.delete(image_id)
+            manifest.forget('image', image_id)
 
-class TestNeutron(unittest.TestCase):
+class TestNeutron(FixtureTestCase):
     """Set of Neutron specific tests"""
     def setUp(self):
-        self.keystone = ksclient.Client(auth_url=keystone_url,
-                                        username=admin_user,
-                                        password=admin_pass,
-                                        tenant_name=admin_tenant)
-        self.t = self.keystone.tenants.create(test_tenant)
-        self.password = str(uuid.uuid4())[:8]
-        self.u = self.keystone.users.create(test_user, self.password, "%s@redhat.com"% test_user, self.t.id)
-        self.endpoint = self.keystone.service_catalog.url_for(service_type='network',
-                                                              endpoint_type='publicURL')
-        self.keystone_testuser = ksclient.Client(auth_url=keystone_url,
-                                        username=test_user,
-                                        password=self.password,
-                                        tenant_name=test_tenant)
-        self.neutron = neutronclient.Client(endpoint_url=self.endpoint, token=self.keystone_testuser.auth_token)
-        self._clean_tenant_networks()
-        
-    def _clean_tenant_networks(self):
-        """Remove any network artifacts left over from failed tests in this tenant"""
-        for p in self.neutron.list_ports().get('ports'):
-            routerid = p.get('device_id')
-            subnetid = p.get('fixed_ips')[0].get('subnet_id')
-            try:
-                self.neutron.remove_interface_router(routerid, {'subnet_id': subnetid})
-            except:
-                pass
-        for r in self.neutron.list_routers().get('routers'):
-            try:
-                self.neutron.delete_router(r.get('id'))
-            except:
-                pass
-        for s in self.neutron.list_subnets().get('subnets'):
-            try:
-                self.neutron.delete_subnet(s.get('id'))
-            except:
-                pass
-        for n in self.neutron.list_networks().get('networks'):
-            if not n.get('router:external'):
-                try:
-                    self.neutron.delete_network(n.get('id'))
-                except:
-                    pass
+        super(TestNeutron, self).setUp()
+        self.neutron = self.fixture.neutron()
+        self.created.clients['neutron'] = self.fixture.new_neutron
     
     def test_001_create_network(self):
         """NEUTRON: we can create a network"""
         network = {'name': 'test_001_network', 'admin_state_up': True}
         n = self.neutron.create_network({'network': network})
         netid = n.get('network', {}).get('id', None)
+        self.created.add('network', netid)
         self.assertTrue(netid)
     
     def test_002_create_network_with_subnet(self):
@@ -187,178 +2491,108 @@ class TestNeutron(unittest.TestCase):
         network = {'name': 'test_002_network', 'admin_state_up': True}
         n = self.neutron.create_network({'network': network})
         netid = n.get('network', {}).get('id', None)
-        subnet = {'name': 'test_002_subnet', 'network_id': netid, 'cidr': '192.168.250.0/24', 'ip_version': 4, 'gateway_ip': '192.168.250.1'}
+        self.created.add('network', netid)
+        cidr, gateway = subnet_range(250)
+        subnet = {'name': 'test_002_subnet', 'network_id': netid, 'cidr': cidr, 'ip_version': 4, 'gateway_ip': gateway}
         s = self.neutron.create_subnet({'subnet': subnet})
         subnetid = s.get('subnet', {}).get('id', None)
+        self.created.add('subnet', subnetid)
         self.assertTrue(subnetid)
     
     def test_003_create_router(self):
         """NEUTRON: we can create two networks with a router"""
-        network1 = {'name': 'test_003_network1', 'admin_state_up': True}
-        n = self.neutron.create_network({'network': network1})
-        netid1 = n.get('network', {}).get('id', None)
-        subnet = {'name': 'test_003_subnet1', 'network_id': netid1, 'cidr': '192.168.251.0/24', 'ip_version': 4, 'gateway_ip': '192.168.251.1'}
-        s = self.neutron.create_subnet({'subnet': subnet})
-        subnetid1 = s.get('subnet', {}).get('id', None)
-        network2 = {'name': 'test_003_network2', 'admin_state_up': True}
-        n = self.neutron.create_network({'network': network2})
-        netid2 = n.get('network', {}).get('id', None)
-        subnet = {'name': 'test_003_subnet2', 'network_id': netid2, 'cidr': '192.168.252.0/24', 'ip_version': 4, 'gateway_ip': '192.168.252.1'}
-        s = self.neutron.create_subnet({'subnet': subnet})
-        subnetid2 = s.get('subnet', {}).get('id', None)
-        router = {'name': 'test_003_router1'}
-        r = self.neutron.create_router({'router': router})
-        routerid = r.get('router', {}).get('id', None)
-        self.neutron.add_interface_router(routerid, {'subnet_id': subnetid1})
-        self.neutron.add_interface_router(routerid, {'subnet_id': subnetid2})
+        spec = {'networks': [{'name': 'test_003_network1', 'subnet': 'test_003_subnet1', 'octet': 251},
+                             {'name': 'test_003_network2', 'subnet': 'test_003_subnet2', 'octet': 252}],
+                'routers': [{'name': 'test_003_router1', 'networks': ['test_003_network1', 'test_003_network2']}]}
+        topology = TopologyBuilder(self.fixture.new_neutron, spec, self.created).build()
+        routerid = topology.routers['test_003_router1']
         self.assertTrue(routerid)
     
-    def tearDown(self):
-        self._clean_tenant_networks()
-        self.keystone.users.delete(self.u)
-        self.keystone.tenants.delete(self.t)
+    def test_004_scale_topology(self):
+        """NEUTRON: we can build a large topology"""
+        if not scale_networks:
+            self.skipTest("scale_networks is 0")
+        spec = scale_topology(scale_networks)
+        start = time.time()
+        topology = TopologyBuilder(self.fixture.new_neutron, spec, self.created).build()
+        sys.stderr.write("(%d networks in %.1fs) "% (scale_networks, time.time() - start))
+        self.assertEqual(len(topology.subnets), scale_networks)
 
-class TestCinder(unittest.TestCase):
+class TestCinder(FixtureTestCase):
     """Set of Cinder-specific tests"""
     def setUp(self):
-        self.keystone = ksclient.Client(auth_url=keystone_url,
-                                        username=admin_user,
-                                        password=admin_pass,
-                                        tenant_name=admin_tenant)
-        self.t = self.keystone.tenants.create(test_tenant)
-        self.password = str(uuid.uuid4())[:8]
-        self.u = self.keystone.users.create(test_user, self.password, "%s@redhat.com"% test_user, self.t.id)
-        self.keystone_testuser = ksclient.Client(auth_url=keystone_url,
-                                                 username=test_user,
-                                                 password=self.password,
-                                                 tenant_name=test_tenant)
-        
-        self.cinder = cinderclient.Client(test_user, self.password, test_tenant, keystone_url)
+        super(TestCinder, self).setUp()
+        self.cinder = self.fixture.cinder()
+        self.created.clients['cinder'] = self.fixture.new_cinder
         if TEST_GLANCE:
-            self.glance_endpoint = self.keystone.service_catalog.url_for(service_type='image',
-                                                                         endpoint_type='publicURL')
-            self.glance = glanceclient.Client(endpoint=self.glance_endpoint, token=self.keystone_testuser.auth_token)
+            self.glance = self.fixture.glance()
     
     def test_001_create_volume(self):
         """CINDER: Create a volume."""
-        self.testvol_001 = self.cinder.volumes.create(display_name="testvol_001", size=1)
+        self.testvol_001 = self.cinder.volumes.create(display_name="testvol_001", size=1, metadata=run_tags())
+        self.created.add('volume', self.testvol_001.id)
         self.assertTrue(self.testvol_001.id)
-        i = 0
-        while (i < test_timeout):
-            vol = self.cinder.volumes.find(id=self.testvol_001.id)
-            if vol.status == u'available':
-                break
-            else:
-                time.sleep(1)
-                i = i + 1
-        if vol.status != u'available':
-            raise TimeoutException("Timeout waiting for volume creation")
+        waiter = StatusWaiter()
+        waiter.watch(self.cinder.volumes.list, self.testvol_001.id, 'available')
+        waiter.wait("volume creation")
     
     def test_002_create_volume_from_image(self):
         """CINDER: Create a volume from a glance image."""
         if TEST_GLANCE:
-            image = None
-            for i in self.glance.images.list():
-                if i.name == glance_image:
-                    image = i
-                    break
-            if image is None:
-                raise TeapotException("Couldn't find image named %s.  Do you need to set glance_image?"% (glance_image,))
-            self.testvol_002 = self.cinder.volumes.create(display_name="testvol_002", size=10, imageRef=image.id)
+            image = references.image(glance_image, self.glance)
+            self.testvol_002 = self.cinder.volumes.create(display_name="testvol_002", size=10, imageRef=image,
+                                                          metadata=run_tags())
+            self.created.add('volume', self.testvol_002.id)
             self.assertTrue(self.testvol_002.id)
-            i = 0
-            while (i < test_timeout):
-                vol = self.cinder.volumes.find(id=self.testvol_002.id)
-                if vol.status == u'available':
-                    break
-                else:
-                    time.sleep(1)
-                    i = i + 1
-            if vol.status != u'available':
-                raise TimeoutException("Timeout waiting for volume creation")
+            waiter = StatusWaiter()
+            waiter.watch(self.cinder.volumes.list, self.testvol_002.id, 'available')
+            waiter.wait("volume creation")
         else:
             pass
     
-    def tearDown(self):
-        i = 0
-        while (i < test_timeout):
-            l = self.cinder.volumes.list()
-            if len(l) == 0:
-                break
-            else:
-                for v in self.cinder.volumes.list():
-                    if v.status == u'available':
-                        self.cinder.volumes.delete(v)
-            time.sleep(1)
-            i = i + 1
-        l = self.cinder.volumes.list()
-        if len(l) > 0:
-            raise TimeoutException("Timeout waiting for volume deletion.")
-        self.keystone.users.delete(self.u)
-        self.keystone.tenants.delete(self.t)
+    def _fanout(self, image=None):
+        if not volume_fanout:
+            self.skipTest("volume_fanout is 0")
+        self.fixture.volume_quota(volume_fanout + 10, (volume_fanout + 10) * max(volume_fanout_size, 10))
+        fanout = VolumeFanout(self.fixture.new_cinder, volume_fanout, volume_fanout_size, image, teardown=self.created)
+        run_reports.append(fanout.run().report())
+        self.assertFalse(fanout.errors, "Volume fan-out errors: %s"% fanout.error_summary())
+    
+    def test_003_create_volumes_concurrently(self):
+        """CINDER: Create many blank volumes at once."""
+        self._fanout()
     
+    def test_004_create_volumes_from_image_concurrently(self):
+        """CINDER: Create many volumes from a glance image at once."""
+        if not TEST_GLANCE:
+            self.skipTest("TEST_GLANCE is off")
+        self._fanout(references.image(glance_image, self.glance))
 
-class TestNova(unittest.TestCase):
+class TestNova(FixtureTestCase):
     """Set of Nova-specific tests."""
-    # Copied from TestNeutron
-    def _clean_tenant_networks(self):
-        """Remove any network artifacts left over from failed tests in this tenant"""
-        for p in self.neutron.list_ports().get('ports'):
-            routerid = p.get('device_id')
-            subnetid = p.get('fixed_ips')[0].get('subnet_id')
-            try:
-                self.neutron.remove_interface_router(routerid, {'subnet_id': subnetid})
-            except:
-                pass
-        for r in self.neutron.list_routers().get('routers'):
-            try:
-                self.neutron.delete_router(r.get('id'))
-            except:
-                pass
-        for s in self.neutron.list_subnets().get('subnets'):
-            try:
-                self.neutron.delete_subnet(s.get('id'))
-            except:
-                pass
-        for n in self.neutron.list_networks().get('networks'):
-            if not n.get('router:external'):
-                try:
-                    self.neutron.delete_network(n.get('id'))
-                except:
-                    pass
-    
     def setUp(self):
-        self.keystone = ksclient.Client(auth_url=keystone_url,
-                                        username=admin_user,
-                                        password=admin_pass,
-                                        tenant_name=admin_tenant)
-        self.t = self.keystone.tenants.create(test_tenant)
-        self.password = str(uuid.uuid4())[:8]
-        self.u = self.keystone.users.create(test_user, self.password, "%s@redhat.com"% test_user, self.t.id)
-        self.keystone_testuser = ksclient.Client(auth_url=keystone_url,
-                                                 username=test_user,
-                                                 password=self.password,
-                                                 tenant_name=test_tenant)
-        
-        self.cinder = cinderclient.Client(test_user, self.password, test_tenant, keystone_url)
-        neutron_endpoint = self.keystone.service_catalog.url_for(service_type='network',
-                                                                 endpoint_type='publicURL')
-        self.neutron = neutronclient.Client(endpoint_url=neutron_endpoint, token=self.keystone_testuser.auth_token)
-        self.nova = novaclient.Client(test_user, self.password, test_tenant, keystone_url)
-        with open(os.path.expanduser('~/.ssh/id_rsa.pub')) as fpubkey:
-            self.nova.keypairs.create(name="mykey", public_key=fpubkey.read())
+        super(TestNova, self).setUp()
+        self.cinder = self.fixture.cinder()
+        self.neutron = self.fixture.neutron()
+        self.nova = self.fixture.nova()
+        self.created.clients.update(cinder=self.fixture.new_cinder, neutron=self.fixture.new_neutron,
+                                    nova=self.fixture.new_nova)
     
     def test_001_launch_single_instance(self):
         """NOVA: Launch a single instance."""
-        f = self.nova.flavors.list()[1]
-        i = self.nova.images.find(name=glance_image)
+        f = references.flavor(self.nova)
+        i = references.image(glance_image)
         
         network = {'name': 'nova_test_001_network', 'admin_state_up': True}
         n = self.neutron.create_network({'network': network})
         netid = n.get('network', {}).get('id', None)
-        subnet = {'name': 'nova_test_001_subnet', 'network_id': netid, 'cidr': '192.168.250.0/24', 'ip_version': 4, 'gateway_ip': '192.168.250.1'}
+        self.created.add('network', netid)
+        cidr, gateway = subnet_range(250)
+        subnet = {'name': 'nova_test_001_subnet', 'network_id': netid, 'cidr': cidr, 'ip_version': 4, 'gateway_ip': gateway}
         s = self.neutron.create_subnet({'subnet': subnet})
-        instance = self.nova.servers.create(name='nova_test_001', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid}])
+        self.created.add('subnet', s.get('subnet', {}).get('id', None))
+        instance = self.nova.servers.create(name='nova_test_001', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid}], meta=run_tags())
+        self.created.add('server', instance.id)
         self.assertTrue(instance)
     
     def test_002_launch_single_instance_with_cinder(self):
@@ -366,100 +2600,339 @@ class TestNova(unittest.TestCase):
         if not TEST_CINDER:
             return
         
-        f = self.nova.flavors.list()[1]
-        i = self.nova.images.find(name=glance_image)
+        f = references.flavor(self.nova)
+        i = references.image(glance_image)
         
         network = {'name': 'nova_test_002_network', 'admin_state_up': True}
         n = self.neutron.create_network({'network': network})
         netid = n.get('network', {}).get('id', None)
-        subnet = {'name': 'nova_test_002_subnet', 'network_id': netid, 'cidr': '192.168.251.0/24', 'ip_version': 4, 'gateway_ip': '192.168.251.1'}
+        self.created.add('network', netid)
+        cidr, gateway = subnet_range(251)
+        subnet = {'name': 'nova_test_002_subnet', 'network_id': netid, 'cidr': cidr, 'ip_version': 4, 'gateway_ip': gateway}
         s = self.neutron.create_subnet({'subnet': subnet})
-        t = self.cinder.volumes.create(display_name="nova_testvol_002", size=10, imageRef=i.id)
-        # Need to wait for the volume to show up in the list here.
-        timeout = 0
-        while (timeout < test_timeout):
-            vol = self.cinder.volumes.find(id=t.id)
-            if vol.status == u'available':
-                break
-            else:
-                time.sleep(1)
-                timeout = timeout + 1
-        instance = self.nova.servers.create(name='nova_test_002', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid}], block_device_mapping={'vda': "%s:"% t.id})
+        self.created.add('subnet', s.get('subnet', {}).get('id', None))
+        t = self.cinder.volumes.create(display_name="nova_testvol_002", size=10, imageRef=i, metadata=run_tags())
+        self.created.add('volume', t.id)
+        waiter = StatusWaiter()
+        waiter.watch(self.cinder.volumes.list, t.id, 'available')
+        waiter.wait("volume creation")
+        instance = self.nova.servers.create(name='nova_test_002', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid}], block_device_mapping={'vda': "%s:"% t.id}, meta=run_tags())
+        self.created.add('server', instance.id)
         self.assertTrue(instance)
     
     def test_003_multivm_with_networks(self):
         """NOVA: Launch several instances attached to networks."""
-        f = self.nova.flavors.list()[1]
-        i = self.nova.images.find(name=glance_image)
-        
-        network = {'name': 'nova_test_003_network1', 'admin_state_up': True}
-        n = self.neutron.create_network({'network': network})
-        netid1 = n.get('network', {}).get('id', None)
-        subnet = {'name': 'nova_test_003_subnet1', 'network_id': netid1, 'cidr': '192.168.252.0/24', 'ip_version': 4, 'gateway_ip': '192.168.252.1'}
-        s = self.neutron.create_subnet({'subnet': subnet})
-        subnetid1 = s.get('subnet', {}).get('id', None)
-        
-        network = {'name': 'nova_test_003_network2', 'admin_state_up': True}
-        n = self.neutron.create_network({'network': network})
-        netid2 = n.get('network', {}).get('id', None)
-        subnet = {'name': 'nova_test_003_subnet2', 'network_id': netid2, 'cidr': '192.168.253.0/24', 'ip_version': 4, 'gateway_ip': '192.168.253.1'}
-        s = self.neutron.create_subnet({'subnet': subnet})
-        subnetid2 = s.get('subnet', {}).get('id', None)
+        f = references.flavor(self.nova)
+        i = references.image(glance_image)
         
-        network = {'name': 'nova_test_003_network3', 'admin_state_up': True}
-        n = self.neutron.create_network({'network': network})
-        netid3 = n.get('network', {}).get('id', None)
-        subnet = {'name': 'nova_test_003_subnet3', 'network_id': netid3, 'cidr': '192.168.254.0/24', 'ip_version': 4, 'gateway_ip': '192.168.254.1'}
-        s = self.neutron.create_subnet({'subnet': subnet})
-        subnetid3 = s.get('subnet', {}).get('id', None)
-        
-        router = {'name': 'nova_test_003_router1'}
-        r = self.neutron.create_router({'router': router})
-        routerid = r.get('router', {}).get('id', None)
-        self.neutron.add_interface_router(routerid, {'subnet_id': subnetid1})
-        self.neutron.add_interface_router(routerid, {'subnet_id': subnetid2})
-        
-        instance1 = self.nova.servers.create(name='nova_test_003_001', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid1}])
-        instance2 = self.nova.servers.create(name='nova_test_003_002', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid1}])
-        instance3 = self.nova.servers.create(name='nova_test_003_003', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid1}])
-        instance4 = self.nova.servers.create(name='nova_test_003_004', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid2}])
-        instance5 = self.nova.servers.create(name='nova_test_003_005', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid2}])
-        instance6 = self.nova.servers.create(name='nova_test_003_006', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid2}])
-        instance7 = self.nova.servers.create(name='nova_test_003_007', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid3}])
-        instance8 = self.nova.servers.create(name='nova_test_003_008', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid3}])
-        instance9 = self.nova.servers.create(name='nova_test_003_009', image=i, flavor=f, key_name='mykey', nics=[{'net-id': netid3}])
+        topology = TopologyBuilder(self.fixture.new_neutron, multivm_topology, self.created).build()
+        pipeline = BootPipeline(self.fixture.new_nova, teardown=self.created)
+        for name, netid, count in topology.instances():
+            pipeline.add('%s_server'% name, i, f, count=count, key_name='mykey', nics=[{'net-id': netid}])
+        pipeline.run()
+        run_reports.append(pipeline.report())
+        self.assertFalse(pipeline.failures(), "Servers didn't go ACTIVE: %s"% ', '.join(pipeline.failures()))
     
-    def tearDown(self):
-        t = test_timeout
-        while (t > 0):
-            if self.nova.servers.list():
-                for s in self.nova.servers.list():
-                    try:
-                        s.delete()
-                    except:
-                        pass
-            else:
-                break
-            time.sleep(1)
-            t = t - 1
-        for v in self.cinder.volumes.list():
-            if v.status == u'available':
-                self.cinder.volumes.delete(v)
-        self._clean_tenant_networks()
-        self.keystone.users.delete(self.u)
-        self.keystone.tenants.delete(self.t)
+def _init_worker(counter, releasing, released):
+    """Give this worker process its own tenant, user and subnet range"""
+    global test_tenant, test_user, subnet_prefix, _releasing, _released
+    with counter.get_lock():
+        counter.value += 1
+        n = counter.value
+    test_tenant = '%s %d'% (test_tenant, n)
+    test_user = '%s%d'% (test_user, n)
+    subnet_prefix = '10.%d'% (n,)
+    _releasing, _released = releasing, released
+    # Only if the run is cut short before _release_worker gets to it
+    multiprocessing.util.Finalize(None, TenantFixture.release, exitpriority=10)
+    transport.reset()
+
+def _worker_pool(processes):
+    """Start processes workers that each get their own tenant, user and subnet range"""
+    sync = (multiprocessing.Value('i', 0), multiprocessing.Value('i', 0), multiprocessing.Event())
+    return multiprocessing.Pool(processes, _init_worker, sync)
+
+def _release_worker(processes):
+    """Delete this worker's fixture and hand over what it leaked along with the worker's state
     
+    Every worker gets exactly one of these: each waits until all of them
+    have been picked up, so no worker can take a second.
+    """
+    with _releasing.get_lock():
+        _releasing.value += 1
+        if _releasing.value == processes:
+            _released.set()
+    _released.wait(test_timeout)
+    leaked = None
+    try:
+        TenantFixture.release()
+    except Exception:
+        leaked = traceback.format_exc()
+    return test_tenant, leaked, _worker_state()
+
+def _release_workers(pool, processes):
+    """Delete every worker's fixture in the worker and return (tenant, traceback) for those that failed"""
+    problems = []
+    for tenant, leaked, state in pool.map(_release_worker, [processes] * processes, 1):
+        _merge_worker_state(state)
+        if leaked is not None:
+            problems.append((tenant, leaked))
+    return problems
+
+def _run_one(cls_name, method):
+    """Run a single test and return the test, its outcome, any traceback and how long it took"""
+    test = globals()[cls_name](method)
+    result = unittest.TestResult()
+    start = time.time()
+    # Run it in a suite so the class fixtures are set up
+    unittest.TestSuite([test]).run(result)
+    elapsed = time.time() - start
+    outcome, detail = 'ok', None
+    if result.skipped:
+        outcome = 'skipped %r'% (result.skipped[0][1],)
+    if result.failures:
+        outcome, detail = 'FAIL', result.failures[0][1]
+    if result.errors:
+        outcome, detail = 'ERROR', result.errors[0][1]
+    return test, outcome, detail, elapsed
+
+def _worker_state():
+    """Hand the run-wide counters collected by this worker over to the parent"""
+    state = {'auths': credentials.auths, 'saved': credentials.saved,
+             'references': (references.lookups, references.hits),
+             'teardown': dict(teardown_totals), 'reports': run_reports[:], 'api': api_metrics.drain(),
+             'connections': connection_stats.drain(), 'imports': dict(import_timings)}
+    credentials.auths = credentials.saved = 0
+    references.lookups = references.hits = 0
+    teardown_totals.clear()
+    del run_reports[:]
+    return state
+
+def _merge_worker_state(state):
+    credentials.auths += state['auths']
+    credentials.saved += state['saved']
+    references.lookups += state['references'][0]
+    references.hits += state['references'][1]
+    for tier, totals in state['teardown'].items():
+        merged = teardown_totals.setdefault(tier, [0, 0, 0.0])
+        for n, value in enumerate(totals):
+            merged[n] += value
+    run_reports.extend(state['reports'])
+    api_metrics.merge(state['api'])
+    connection_stats.merge(state['connections'])
+    for name, elapsed in state['imports'].items():
+        import_timings[name] = max(elapsed, import_timings.get(name, 0))
+
+def _run_test(name):
+    """Run a single (class name, method name) test in a worker process"""
+    test, outcome, detail, elapsed = _run_one(*name)
+    return str(test), test.shortDescription(), outcome, detail, elapsed, _worker_state()
+
+def run_parallel(classes, processes):
+    """Run the test methods of classes across a pool of worker processes
+    
+    Every worker has its own tenant, user and subnet range so that tests
+    running at the same time don't clobber each other.  The slowest suites
+    are scheduled first and the results are merged into a single report.
+    """
+    loader = unittest.TestLoader()
+    names = []
+    for cls in sorted(classes, key=lambda c: -expected_durations.get(c.__name__, 0)):
+        names.extend((cls.__name__, m) for m in loader.getTestCaseNames(cls))
+    pool = _worker_pool(processes)
+    problems = []
+    start = time.time()
+    try:
+        for name, description, outcome, detail, elapsed, state in pool.imap_unordered(_run_test, names):
+            sys.stderr.write("%s ... %s (%.1fs)\n"% (description or name, outcome, elapsed))
+            _merge_worker_state(state)
+            if detail is not None:
+                problems.append((outcome, description or name, detail))
+        for tenant, detail in _release_workers(pool, processes):
+            problems.append(('ERROR', "Teardown of %s"% tenant, detail))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    sys.stderr.write("\n")
+    for outcome, name, detail in problems:
+        sys.stderr.write("%s\n%s: %s\n%s\n%s\n"% ('=' * 70, outcome, name, '-' * 70, detail))
+    sys.stderr.write("%s\nRan %d tests in %.3fs across %d workers\n\n"% ('-' * 70, len(names), elapsed, processes))
+    failures = len([p for p in problems if p[0] == 'FAIL'])
+    errors = len(problems) - failures
+    if problems:
+        sys.stderr.write("FAILED (failures=%d, errors=%d)\n"% (failures, errors))
+    else:
+        sys.stderr.write("OK\n")
+    return not problems
+
+def _load_worker(args):
+    """Run randomly picked load scenarios in a worker until the deadline or iteration count is reached"""
+    deadline, iterations, seed = args
+    random.seed(seed)
+    choices = []
+    for scenario, weight in sorted(load_mix.items()):
+        choices.extend([scenario] * weight)
+    samples = []
+    while time.time() < deadline and (iterations is None or len(samples) < iterations):
+        scenario = random.choice(choices)
+        start = time.time()
+        test, outcome, detail, elapsed = _run_one(*load_scenarios[scenario])
+        samples.append((start + elapsed, scenario, elapsed, outcome == 'ok'))
+    return samples, _worker_state()
+
+def run_load(processes, duration=None, iterations=None):
+    """Run the load_mix of scenarios continuously across processes isolated tenants
+    
+    Returns the (finish time, scenario, latency, succeeded) samples and the
+    time the run started.
+    """
+    if duration is None and iterations is None:
+        duration = 60
+    start = time.time()
+    deadline = start + duration if duration is not None else float('inf')
+    per_worker = [None] * processes
+    if iterations is not None:
+        per_worker = [iterations / processes + (1 if n < iterations % processes else 0) for n in range(processes)]
+    jobs = [(deadline, per_worker[n], random.random()) for n in range(processes)]
+    pool = _worker_pool(processes)
+    samples = []
+    try:
+        for worker_samples, state in pool.imap_unordered(_load_worker, jobs):
+            samples.extend(worker_samples)
+            _merge_worker_state(state)
+        for tenant, detail in _release_workers(pool, processes):
+            sys.stderr.write("Teardown of %s failed:\n%s\n"% (tenant, detail))
+    finally:
+        pool.close()
+        pool.join()
+    return samples, start
+
+def load_report(samples, start, interval=None):
+    """Summarize throughput, latency and errors overall, per scenario and over time"""
+    interval = interval or load_interval
+    if not samples:
+        return "Load: no operations completed"
+    elapsed = max(s[0] for s in samples) - start
+    errors = len([s for s in samples if not s[3]])
+    lines = ["Load: %d operations in %.1fs, %.2f ops/s, %.1f%% errors"% (len(samples), elapsed,
+                                                                       len(samples) / max(elapsed, 0.001),
+                                                                       100.0 * errors / len(samples))]
+    for scenario in sorted(set(s[1] for s in samples)):
+        ran = [s for s in samples if s[1] == scenario]
+        failed = len([s for s in ran if not s[3]])
+        lines.append("  %-10s %5d ops  %5.1f%% errors  %s"% (scenario, len(ran), 100.0 * failed / len(ran),
+                                                           latency_summary([s[2] for s in ran if s[3]])))
+    lines.append("  Over time:")
+    buckets = {}
+    for s in samples:
+        buckets.setdefault(int((s[0] - start) // interval), []).append(s)
+    for bucket in sorted(buckets):
+        ran = buckets[bucket]
+        failed = len([s for s in ran if not s[3]])
+        lines.append("  %6ds  %7.2f ops/s  %5.1f%% errors  %s"% (bucket * interval, len(ran) / float(interval),
+                                                              100.0 * failed / len(ran),
+                                                              latency_summary([s[2] for s in ran if s[3]])))
+    return '\n'.join(lines)
+
+def run_bench(classes, config_file=None):
+    """Run each suite against an in-process fakestack cloud
+    
+    Returns (suite, tests, problems, API calls, wall time) for every suite so
+    that client-side overhead can be compared without a real cloud.
+    """
+    global keystone_url, admin_user, admin_pass, admin_tenant
+    import fakestack
+    config = fakestack.load_config(config_file) if config_file else None
+    fake = fakestack.FakeStack(config=config).start()
+    keystone_url = fake.keystone_url
+    admin_user, admin_pass, admin_tenant = (fake.config['admin_user'], fake.config['admin_pass'],
+                                            fake.config['admin_tenant'])
+    rows = []
+    try:
+        for cls in classes:
+            calls = fake.calls()
+            start = time.time()
+            suite = unittest.TestLoader().loadTestsFromTestCase(cls)
+            result = unittest.TextTestRunner(verbosity=2).run(suite)
+            TenantFixture.release()
+            rows.append((cls.__name__, result.testsRun, len(result.failures) + len(result.errors),
+                         fake.calls() - calls, time.time() - start))
+    finally:
+        fake.stop()
+    return rows
+
+def bench_report(rows):
+    lines = ["Bench: %d API calls in %.1fs against fakestack"% (sum(r[3] for r in rows), sum(r[4] for r in rows))]
+    for suite, tests, problems, calls, elapsed in rows:
+        lines.append("  %-14s %3d tests  %3d problems  %6d API calls  %7.2fs"% (suite, tests, problems, calls, elapsed))
+    return '\n'.join(lines)
+
+def startup_report(first):
+    """Report how long it took to get to the first test and to import the client libraries
+    
+    The clients are imported lazily once the tests are running, so their
+    import time is reported on its own rather than in the time to the
+    first test.  In parallel runs it is the slowest import of each library
+    across the workers.
+    """
+    imports = ', '.join('%s %.2fs'% (name, elapsed) for name, elapsed in sorted(import_timings.items()))
+    return "Startup: %.2fs to the first test excluding client imports, %.2fs importing clients: %s"% (
+        first - started, sum(import_timings.values()), imports or 'none')
+
+def print_run_summary():
+    """Print the reports and counters collected over the run"""
+    if first_test is not None:
+        print startup_report(first_test)
+    for report in run_reports:
+        print report
+    print credentials.report()
+    print identity_report()
+    print references.report()
+    if teardown_totals:
+        print teardown_report()
+    print api_metrics.report()
+    print connection_stats.report()
+    if api_report_file:
+        api_metrics.write(api_report_file)
+    left = manifest.close()
+    if left:
+        print "Run %s: %d resources left behind, see %s or run 'teapot.py sweep'"% (run_id, len(left), manifest.path)
+
 def usage():
     """ Print usage information for command-line use """
     msg = """
-Usage: teapot.py [OPTION]... [manual]
+Usage: teapot.py [OPTION]... [manual|load|identity|bench|sweep]
   Run teapot with the following options:
   
   -k    Keystone URL (defaults to 'http://127.0.0.1:5000/v2.0')
   -u    Admin username
   -p    Admin password
+  -j    Number of worker processes to run tests in parallel (defaults to 1)
+  -s    Number of networks to build in the neutron scale test (defaults to 0)
+  -t    JSON topology spec to build in manual mode
+  -o    Write per-operation API call latencies to this .csv or .json file
+  -d    Number of seconds to run load mode for (defaults to 60)
+  -i    Number of scenarios to run in load mode instead of a duration
+  -x    Load mode scenario mix, e.g. volume=2,network=1,instance=1
+  -U    Number of users to create in identity mode (defaults to 100)
+  -T    Number of tenants to spread them across (defaults to 10)
+  -F    JSON file of fakestack settings for bench mode
+  -m    Size in MB of the images pushed through glance (defaults to 0, which skips it)
+  -g    Number of glance transfers to run at once (defaults to 1)
+  -v    Number of volumes to create at once in the cinder fan-out tests (defaults to 0)
+  -C    Most calls in flight per service on the event loop, e.g. cinder=100,nova=20
+  -n    Number of idle environments "manual prewarm" keeps ready (defaults to 1)
+  -c    Components to test, e.g. keystone,glance (defaults to all of them)
+  -S    Let every client open its own connections and log in on its own
 
-  Specify "manual" to create a test environment for manual testing.
+  Specify "manual" to get a test environment for manual testing, reusing a
+  saved one when possible.  "manual prewarm" builds -n idle environments
+  ahead of time and "manual destroy" tears all of them down.
+  Specify "load" to run scenarios continuously in -j isolated tenants.
+  Specify "identity" to benchmark keystone with -j concurrent requests.
+  Specify "bench" to run the suites against an in-process fake cloud.
+  Specify "sweep" to delete what crashed runs left behind.
   
 Example:
   teapot.py -k http://127.0.0.1:5000/v2.0 -u admin -p password manual
@@ -468,7 +2941,7 @@ Example:
 
 if __name__ == '__main__':
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'k:u:p:h')
+        opts, args = getopt.getopt(sys.argv[1:], 'k:u:p:j:s:t:o:d:i:x:U:T:F:c:m:g:v:n:C:Sh')
         
         for o, a in opts:
             if o == "-h":
@@ -480,32 +2953,119 @@ if __name__ == '__main__':
                 admin_user = a
             elif o == "-p":
                 admin_pass = a
+            elif o == "-j":
+                workers = int(a)
+            elif o == "-s":
+                scale_networks = int(a)
+            elif o == "-t":
+                multivm_topology = load_topology(a)
+            elif o == "-o":
+                api_report_file = a
+            elif o == "-d":
+                load_duration = float(a)
+            elif o == "-i":
+                load_iterations = int(a)
+            elif o == "-x":
+                load_mix = {}
+                for item in a.split(','):
+                    scenario, _, weight = item.partition('=')
+                    if scenario not in load_scenarios:
+                        raise TeapotException("Unknown load scenario %s, expected one of %s"% (scenario, ', '.join(sorted(load_scenarios))))
+                    load_mix[scenario] = int(weight or 1)
+            elif o == "-U":
+                identity_users = int(a)
+            elif o == "-T":
+                identity_tenants = int(a)
+            elif o == "-F":
+                fake_config = a
+            elif o == "-m":
+                image_transfer_size = int(a)
+            elif o == "-g":
+                image_transfers = int(a)
+            elif o == "-v":
+                volume_fanout = int(a)
+            elif o == "-C":
+                for item in a.split(','):
+                    service, _, limit = item.partition('=')
+                    if service not in service_concurrency:
+                        raise TeapotException("Unknown service %s, expected one of %s"% (service, ', '.join(sorted(service_concurrency))))
+                    service_concurrency[service] = int(limit)
+            elif o == "-n":
+                env_pool_size = int(a)
+            elif o == "-S":
+                shared_transport = False
+            elif o == "-c":
+                selected = a.lower().split(',')
+                for component in selected:
+                    if component not in components:
+                        raise TeapotException("Unknown component %s, expected one of %s"% (component, ', '.join(components)))
+                for component in components:
+                    globals()['TEST_%s'% component.upper()] = component in selected
         
         if "manual" in args:
-             print "Creating environment for manual testing"
-             tc = TestNova('test_003_multivm_with_networks')
-             tc.setUp()
-             tc.test_003_multivm_with_networks()
-             print "Environment created.  Tenant username is %s and password is %s"% (test_user, tc.password)
-             print "Press enter to tear down the environment"
-             sys.stdin.readline()
-             print "Tearing down environment"
-             tc.tearDown()
-             print "Finished"
-             sys.exit()
+            # Repairs and teardowns record into the run manifest, which is
+            # otherwise only closed by print_run_summary
+            try:
+                pool = EnvironmentPool()
+                if "destroy" in args:
+                    pool.destroy()
+                    sys.exit()
+                if "prewarm" in args:
+                    pool.prewarm(env_pool_size)
+                    sys.exit()
+                print "Getting an environment for manual testing"
+                start = time.time()
+                env, how = pool.acquire()
+                print "Environment %s %s in %.1fs.  Tenant username is %s and password is %s"% (env.name, how, time.time() - start,
+                                                                                               env.user_name, env.password)
+                print "Press enter to return the environment to the pool"
+                sys.stdin.readline()
+                pool.release(env)
+                print "Finished.  Environments are kept in %s; run 'teapot.py manual destroy' to tear them down"% pool.path
+                sys.exit()
+            finally:
+                manifest.close()
+        
+        if "sweep" in args:
+            print sweep()
+            sys.exit()
+        
+        if "load" in args:
+            print "Running load with %d workers"% (workers,)
+            samples, start = run_load(workers, load_duration, load_iterations)
+            print load_report(samples, start)
+            print_run_summary()
+            sys.exit()
+        
+        if "identity" in args:
+            benchmark = IdentityBenchmark(credentials.admin(), identity_users, identity_tenants, workers)
+            print benchmark.run().report()
+            print_run_summary()
+            sys.exit()
     except:
         raise
 
-    suites = []
+    classes = []
     if TEST_KEYSTONE:
-        suites.append(unittest.TestLoader().loadTestsFromTestCase(TestKeystone))
+        classes.append(TestKeystone)
     if TEST_GLANCE:
-        suites.append(unittest.TestLoader().loadTestsFromTestCase(TestGlance))
+        classes.append(TestGlance)
     if TEST_NEUTRON:
-        suites.append(unittest.TestLoader().loadTestsFromTestCase(TestNeutron))
+        classes.append(TestNeutron)
     if TEST_CINDER:
-        suites.append(unittest.TestLoader().loadTestsFromTestCase(TestCinder))
+        classes.append(TestCinder)
     if TEST_NOVA:
-        suites.append(unittest.TestLoader().loadTestsFromTestCase(TestNova))
-    suite = unittest.TestSuite(suites)
-    unittest.TextTestRunner(verbosity=2).run(suite)
+        classes.append(TestNova)
+    first_test = time.time()
+    if "bench" in args:
+        print bench_report(run_bench(classes, fake_config))
+        print_run_summary()
+        sys.exit()
+    if workers > 1:
+        run_parallel(classes, workers)
+    else:
+        suites = [unittest.TestLoader().loadTestsFromTestCase(c) for c in classes]
+        suite = unittest.TestSuite(suites)
+        unittest.TextTestRunner(verbosity=2).run(suite)
+        TenantFixture.release()
+    print_run_summary()